@@ -20,6 +20,7 @@ Carriage returns ('\r') are discarded and ignored.
 
 unsigned long latestStatusReportTime=0;
 bool rebooted = true;
+bool compactStatus = false; // True: report status as one compact line. False: one line per value.
 
 void setup() {
   // Serial.begin(9600);
@@ -65,7 +66,42 @@ void reportMotorDirection() {
   }
 }
 
+// Direction as reported to the client: 0 = neither, 1 = left, 2 = right.
+int directionCode(MotorDirection direction) {
+  switch (direction) {
+    case MotorDirectionLeft: return 1;
+    case MotorDirectionRight: return 2;
+    default: return 0;
+  }
+}
+
+// Report all status values in one fixed-layout line: z=CLLLLRRRRSSSDPPPPX*HH
+// C clutch, LLLL left limit, RRRR right limit, SSS motor speed, D motor direction, PPPP position,
+// X limit exception direction, HH hex checksum (XOR of the characters between "z=" and "*").
+void reportCompactStatus() {
+  char report[19]; // 18 characters plus terminator
+  snprintf(report, sizeof(report), "%1d%04d%04d%03d%1d%04d%1d",
+           (getClutch() == ClutchEnabled) ? 1 : 0,
+           getLimit(MotorDirectionLeft),
+           getLimit(MotorDirectionRight),
+           getMotorSpeed(),
+           directionCode(getMotorDirection()),
+           getPosition(),
+           directionCode(getLimitExceptionDirection()));
+  uint8_t checksum = 0;
+  for (char *c = report; *c != '\0'; c++) checksum ^= *c;
+  Serial.print("z=");
+  Serial.print(report);
+  Serial.print('*');
+  printHex(checksum);
+  Serial.println();
+}
+
 void reportStatus() {
+  if (compactStatus) {
+    reportCompactStatus();
+    return;
+  }
   reportClutchStatus();
   reportLimits();
   reportMotorSpeed();
@@ -126,6 +162,14 @@ void processCommand(char *command) {
       if (cmdlen < 5) Serial.println("m=Missing parm for 'i'");
       else setStatusInterval(getDecimal(parm, 4));
       break;
+    case 'f': // Set status format. f1 is one compact line per report. f0 is one line per value.
+      if (cmdlen < 2) Serial.println("m=Missing parm for 'f'");
+      else switch(command[1]) {
+        case '1': compactStatus = true; break;
+        case '0': compactStatus = false; break;
+        default: Serial.println("m=Bad parm for 'f'");
+      }
+      break;
     default: 
       Serial.println("m=Unrecognized command:" + String(command)); 
     }
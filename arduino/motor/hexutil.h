@@ -9,7 +9,8 @@ uint8_t hexToDec(char *hex) {
 
 #define dec2hexDigit(nibble) ((nibble) <= 9 ? (nibble) + '0' : (nibble) - 10 + 'a')
 // Print a 2-digit (one byte, two nibble) hex number for an 8-bit decimal value.
+// dec2hexDigit is an int, which Serial.print would print as a decimal number, so print it as a char.
 void printHex(uint8_t dec) {
-  Serial.print(dec2hexDigit(dec >> 4));
-  Serial.print(dec2hexDigit(dec & 0x0F));
+  Serial.print((char) dec2hexDigit(dec >> 4));
+  Serial.print((char) dec2hexDigit(dec & 0x0F));
 }
@@ -0,0 +1,213 @@
+## Adrian Vrouwenvelder
+## March 2023
+
+# Emulates the motor controller sketch (arduino/motor/adrianAutoPilot.ino) on a Linux pseudo-terminal, so that
+# ArduinoSerialInterface can be run, and benchmarked, end to end without the hardware:
+#   emulator = ArduinoEmulator()
+#   emulator.start()
+#   interface = ArduinoSerialInterface(usb=emulator.port)
+# Implements the c, d, s, l, r, i and f commands, moves the rudder at a configurable speed while the motor runs
+# (stopping at the limits, as the sketch does), and reports status every status interval.
+#
+# Run this file to benchmark command round-trip latency and status throughput:
+#   PYTHONPATH=../web python3 arduinoEmulator.py --help
+
+import argparse
+import os
+import pty
+import select
+import threading
+import time
+import tty
+
+MOTOR_NEITHER, MOTOR_LEFT, MOTOR_RIGHT = 0, 1, 2  # As reported by the sketch
+
+
+# See dec2hexDigit in hexutil.h
+def dec2hex_digit(nibble: int) -> str:
+    return chr(nibble + ord('0') if nibble <= 9 else nibble - 10 + ord('a'))
+
+
+# See printHex in hexutil.h: the two nibbles of a byte, as characters.
+def print_hex(dec: int) -> str:
+    return dec2hex_digit(dec >> 4) + dec2hex_digit(dec & 0x0F)
+
+
+class ArduinoEmulator:
+
+    # rudder_speed: rudder sensor units per second at full motor speed (255).
+    def __init__(self, rudder_speed=200.0, position=512, left_limit=100, right_limit=900):
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._running = False
+        self._command = b''
+
+        self.rudder_speed = rudder_speed
+        self.position = float(position)
+        self.left_limit = left_limit
+        self.right_limit = right_limit
+        self.clutch = 0
+        self.motor_speed = 0
+        self.motor_direction = MOTOR_NEITHER
+        self.status_interval_ms = 1000
+        self.compact_status = False
+        self.commands_received = 0
+        self.reports_sent = 0
+
+    def start(self):
+        self._running = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def is_running(self):
+        return self._running
+
+    def _send(self, line: str):
+        os.write(self._master, (line + "\r\n").encode())
+
+    # See getLimitExceptionDirection in motorController.h
+    def get_limit_exception_direction(self) -> int:
+        lower_limit_is_left = self.left_limit < self.right_limit
+        lower_limit = self.left_limit if lower_limit_is_left else self.right_limit
+        upper_limit = self.right_limit if lower_limit_is_left else self.left_limit
+        direction = MOTOR_NEITHER
+        if self.position < lower_limit:
+            direction = MOTOR_LEFT if lower_limit_is_left else MOTOR_RIGHT
+        elif self.position > upper_limit:
+            direction = MOTOR_RIGHT if lower_limit_is_left else MOTOR_LEFT
+        return direction if direction == self.motor_direction else MOTOR_NEITHER
+
+    # Move the rudder for dt_s seconds, at the current motor speed and direction.
+    def move(self, dt_s: float):
+        if self.motor_direction == MOTOR_NEITHER or self.get_limit_exception_direction() != MOTOR_NEITHER:
+            return
+        towards_right = (self.motor_direction == MOTOR_RIGHT) == (self.left_limit < self.right_limit)
+        distance = self.rudder_speed * (self.motor_speed / 255) * dt_s
+        self.position = min(1023.0, max(0.0, self.position + (distance if towards_right else -distance)))
+
+    # See processCommand in adrianAutoPilot.ino
+    def process_command(self, command: str):
+        self.commands_received += 1
+        if len(command) == 0:
+            return
+        parm = command[1:]
+        letter = command[0]
+        if letter == 'c':
+            if len(parm) < 1: self._send("m=Missing parm for 'c'")
+            elif parm[0] in '01': self.clutch = int(parm[0])
+            else: self._send("m=Bad parm for 'c'")
+        elif letter == 'd':
+            if len(parm) < 1: self._send("m=Missing parm for 'd'")
+            elif parm[0] in '012': self.motor_direction = int(parm[0])
+            else: self._send("m=Bad parm for 'd'")
+        elif letter == 's':
+            if len(parm) < 3: self._send("m=Missing parm for 's'")
+            else: self.motor_speed = int(parm[:3]) & 0xFF
+        elif letter == 'l':
+            if len(parm) < 4: self._send("m=Missing parm for 'l'")
+            else: self.left_limit = int(parm[:4])
+        elif letter == 'r':
+            if len(parm) < 4: self._send("m=Missing parm for 'r'")
+            else: self.right_limit = int(parm[:4])
+        elif letter == 'i':
+            if len(parm) < 4: self._send("m=Missing parm for 'i'")
+            else: self.status_interval_ms = int(parm[:4])
+        elif letter == 'f':
+            if len(parm) < 1: self._send("m=Missing parm for 'f'")
+            elif parm[0] in '01': self.compact_status = parm[0] == '1'
+            else: self._send("m=Bad parm for 'f'")
+        else:
+            self._send("m=Unrecognized command:" + command)
+
+    # See reportStatus and reportCompactStatus in adrianAutoPilot.ino
+    def report_status(self):
+        position = int(self.position)
+        exception_direction = self.get_limit_exception_direction()
+        if self.compact_status:
+            report = f"{self.clutch:1d}{self.left_limit:04d}{self.right_limit:04d}{self.motor_speed:03d}" \
+                     f"{self.motor_direction:1d}{position:04d}{exception_direction:1d}"
+            checksum = 0
+            for c in report.encode():
+                checksum ^= c
+            self._send("z=" + report + '*' + print_hex(checksum))
+        else:
+            self._send(f"c={self.clutch}\r\nl={self.left_limit}\r\nr={self.right_limit}\r\ns={self.motor_speed}\r\n"
+                       f"d={self.motor_direction}\r\np={position}\r\nx={exception_direction}")
+        self.reports_sent += 1
+
+    def run(self):
+        self._send("m=REBOOTED")
+        last_move_s = time.monotonic()
+        last_report_s = last_move_s - self.status_interval_ms / 1000
+        while self.is_running():
+            # As in the sketch, the report is due status interval after the last, even if the interval just changed.
+            next_report_s = last_report_s + self.status_interval_ms / 1000
+            now_s = time.monotonic()
+            readable, _, _ = select.select([self._master], [], [], max(0.0, min(next_report_s - now_s, 0.01)))
+            if readable:
+                self._command += os.read(self._master, 1024)
+                while b'\n' in self._command:
+                    command, self._command = self._command.split(b'\n', 1)
+                    self.process_command(command.replace(b'\r', b'').decode())
+            now_s = time.monotonic()
+            self.move(now_s - last_move_s)
+            last_move_s = now_s
+            if now_s >= last_report_s + self.status_interval_ms / 1000:
+                self.report_status()
+                last_report_s = now_s
+
+
+################################################################################
+# End-to-end benchmark of ArduinoSerialInterface against the emulator.
+def benchmark(round_trips, duration_s, status_interval_ms, compact, rudder_speed):
+    from modules.arduinoSerialInterface import getInterface
+    from modules.scheduler import TimingStats
+
+    emulator = ArduinoEmulator(rudder_speed=rudder_speed)
+    emulator.start()
+    interface = getInterface(usb=emulator.port)
+    interface.start()
+    interface.set_compact_status(compact)
+    interface.set_status_interval(status_interval_ms)
+    time.sleep(0.5)
+
+    # Round trip: clutch command out, until the clutch status reported back has changed.
+    round_trip = TimingStats(round_trips)
+    for k in range(round_trips):
+        status = (k + 1) % 2
+        start_s = time.monotonic()
+        interface.set_status(status)
+        while interface.get_status() != status:
+            time.sleep(0.0001)
+        round_trip.add(time.monotonic() - start_s)
+    print(f"Round trip (status interval {status_interval_ms} ms): {round_trip.summary_ms()}")
+
+    # Throughput: status reports per second, as sent by the emulator and as applied by the interface.
+    reports_sent = emulator.reports_sent
+    reports_applied = interface.get_reports_applied()
+    time.sleep(duration_s)
+    print(f"Reports sent: {(emulator.reports_sent - reports_sent) / duration_s:.1f}/s, "
+          f"applied: {(interface.get_reports_applied() - reports_applied) / duration_s:.1f}/s")
+    print(f"Interface: {interface.get_stats()}")
+    interface.stop()
+    emulator.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark ArduinoSerialInterface against an emulated Arduino.")
+    parser.add_argument("--round-trips", type=int, default=100, help="Clutch command round trips to time")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds to measure status throughput over")
+    parser.add_argument("--status-interval", type=int, default=10, help="Arduino status interval, in ms")
+    parser.add_argument("--compact", action="store_true", help="Use the compact (f1) status report")
+    parser.add_argument("--rudder-speed", type=float, default=200.0,
+                        help="Rudder sensor units per second at full motor speed")
+    args = parser.parse_args()
+    benchmark(args.round_trips, args.duration, args.status_interval, args.compact, args.rudder_speed)
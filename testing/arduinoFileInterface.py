@@ -1,7 +1,7 @@
 ## Adrian Vrouwenvelder
 ## December 1, 2022
 
-from modules.arduinoInterface import ArduinoInterface, from_arduino
+from modules.arduinoInterface import ArduinoInterface, apply_arduino_lines
 from pathlib import Path
 import time
 
@@ -16,9 +16,8 @@ class ArduinoFileInterface(ArduinoInterface):
         while (self.is_running()):
             my_file = Path(fromArduinoFile)
             if my_file.is_file():
-                with open(fromArduinoFile) as openfileobject:
-                    for line in openfileobject:
-                        from_arduino(interface=self, msg=line)
+                with open(fromArduinoFile, 'rb') as openfileobject:
+                    apply_arduino_lines(interface=self, lines=openfileobject.read().split(b'\n'))
                 open(fromArduinoFile, 'w').close() # Delete contents
             time.sleep(self.get_check_interval())
 
@@ -0,0 +1,185 @@
+# Author: Adrian Vrouwenvelder
+#
+# Batch version of simulator.py's run_simulation: steps many boats, each with its own PID gains (and, optionally,
+# its own starting heading, target and boat characteristics), together, as NumPy arrays, one time step at a time.
+# Thousands of gain sets take about as long as a handful did one at a time, which makes sweeping or optimizing
+# gains practical.
+#
+# Each step does exactly what run_simulation does with one Boat and one PID, in the same order and with the same
+# arithmetic (see step()), on the same VirtualClock ticks, so its headings match run_simulation's to within
+# rounding. Only the logging, CSV and plots are left out: use simulator.py to look at a single run in detail.
+#
+# Run alongside simulator.py:
+#   python3 batch_simulator.py ../configuration/config.yaml 0.01:2.0:40 0:0.001:5 0:1.0:5    # P, I, D as start:stop:count
+
+import sys
+import time as real_time
+
+import numpy as np
+
+from config import Config as BoatConfig
+from simulation_trace import SimulationTrace
+
+Course_Correction_Timeout = 60  # Simulated seconds per run, as in simulator.py
+Settled_Tolerance_Deg = 2.0  # A run has settled once its error stays within this
+
+
+# calculate_angle_difference() from anglemath.py, over arrays.
+def calculate_angle_differences(desired, actual):
+    angle = (actual - desired + 180) % 360 - 180
+    return np.where(angle < -180, angle + 360, angle)
+
+
+class BatchSimulation:
+
+    # Gains, headings, targets and boat characteristics are broadcast against each other: pass arrays for the
+    # values that vary between runs, and single values for the rest.
+    def __init__(self, p_gains, i_gains, d_gains, initial_headings, target_values,
+                 max_rudder_deflection_deg, rudder_speed_dps, max_boat_turn_rate_dps, sampling_interval_ms,
+                 settled_tolerance_deg=Settled_Tolerance_Deg, wave_yaw_dps=0.0, wave_period_s=8.0, wave_phase=0.0):
+        (self.p_gain, self.i_gain, self.d_gain, self.heading, self.target_value,
+         self.max_rudder_deflection_deg, self.rudder_speed_dps, self.max_boat_turn_rate_dps,
+         self.wave_yaw_dps, self.wave_period_s, self.wave_phase) = \
+            (a.astype(float) for a in np.broadcast_arrays(p_gains, i_gains, d_gains, initial_headings, target_values,
+                                                          max_rudder_deflection_deg, rudder_speed_dps,
+                                                          max_boat_turn_rate_dps, wave_yaw_dps, wave_period_s,
+                                                          wave_phase))
+        # Waves yaw the boat back and forth by up to wave_yaw_dps, over wave_period_s. None by default, as in
+        # run_simulation.
+        self.waves = bool(np.any(self.wave_yaw_dps != 0))
+        self.heading = self.heading.copy()  # Broadcast arrays share memory; the heading is updated in place.
+        self.runs = self.heading.shape
+        self.dt = float(sampling_interval_ms)  # PID sample interval, in ms, as PID.dt
+        self.settled_tolerance_deg = settled_tolerance_deg
+        # Boat
+        self.commanded_rudder_deflection_deg = np.zeros(self.runs)
+        self.current_rudder_deflection_deg = np.zeros(self.runs)
+        # PID, as left by PID.set_target_value()
+        self.err = calculate_angle_differences(self.target_value, 0.0)
+        self.prev_err = np.zeros(self.runs)
+        self.i_val = np.zeros(self.runs)
+        # Clock: a new VirtualClock's. The boat is created, and the run starts, at 0.
+        self.now_s = 0.0
+        self.prev_adjustment_time_s = 0.0
+        self.runtime_s = 0.0
+        # Metrics
+        self.initial_err = calculate_angle_differences(self.target_value, self.heading)
+        self.iae = np.zeros(self.runs)  # Integral of absolute error, degree seconds
+        self.overshoot_deg = np.zeros(self.runs)  # Furthest past the target, on the far side from the start
+        self.rudder_travel_deg = np.zeros(self.runs)
+        self.max_rudder_deg = np.zeros(self.runs)
+        self.last_unsettled_s = np.zeros(self.runs)
+        self.steps = 0
+        self.trace: SimulationTrace = None
+
+    # One pass of run_simulation's loop: PID.compute_output, Boat.request_rudder_angle, Boat.tick and PID.wait.
+    def step(self):
+        # PID.compute_output
+        self.err = calculate_angle_differences(self.target_value, self.heading)
+        p_val = self.p_gain * self.err
+        self.i_val = self.err * self.i_gain * self.dt + self.i_val
+        d_val = self.d_gain * (self.prev_err - self.err) / self.dt
+        self.prev_err = self.err
+        pid_correction = -(p_val + self.i_val + d_val)
+        # Boat.request_rudder_angle
+        max_deflection = self.max_rudder_deflection_deg
+        self.commanded_rudder_deflection_deg = np.where(pid_correction > max_deflection, max_deflection,
+                                                        np.where(pid_correction < -max_deflection, -max_deflection,
+                                                                 pid_correction))
+        self._measure()
+        if self.trace is not None:
+            self.trace.append(self.now_s, self.heading.ravel(), self.err.ravel(), pid_correction.ravel(),
+                              self.current_rudder_deflection_deg.ravel())
+        # Boat.tick
+        dt_s = self.now_s - self.prev_adjustment_time_s
+        self.prev_adjustment_time_s = self.now_s
+        rudder = self.current_rudder_deflection_deg
+        rudder_deflection_diff_deg = -calculate_angle_differences(self.commanded_rudder_deflection_deg, rudder)
+        direction_of_movement = np.where(rudder_deflection_diff_deg >= 0, 1, -1)
+        moved = rudder + direction_of_movement * self.rudder_speed_dps * dt_s
+        moved = np.where(moved > max_deflection, max_deflection, moved)
+        moved = np.where(moved < -max_deflection, -max_deflection, moved)
+        new_rudder = np.where(np.abs(rudder_deflection_diff_deg) > .1, moved, rudder)
+        self.rudder_travel_deg += np.abs(new_rudder - rudder)
+        self.current_rudder_deflection_deg = new_rudder
+        rudder_percent = new_rudder / max_deflection
+        boat_turn_rate_dps = rudder_percent * self.max_boat_turn_rate_dps
+        if self.waves:
+            boat_turn_rate_dps = boat_turn_rate_dps + self.wave_yaw_dps * np.sin(2 * np.pi * self.now_s / self.wave_period_s + self.wave_phase)
+        self.heading = (self.heading + boat_turn_rate_dps * dt_s) % 360
+        # PID.wait
+        self.now_s = self.now_s + self.dt / 1000
+        self.runtime_s = self.now_s
+        self.steps += 1
+
+    # Metrics from the error this step's PID output was computed from, as run_simulation would log it.
+    def _measure(self):
+        abs_err = np.abs(self.err)
+        self.iae += abs_err * self.dt / 1000
+        np.maximum(self.overshoot_deg, -np.sign(self.initial_err) * self.err, out=self.overshoot_deg)
+        np.maximum(self.max_rudder_deg, np.abs(self.current_rudder_deflection_deg), out=self.max_rudder_deg)
+        self.last_unsettled_s = np.where(abs_err > self.settled_tolerance_deg, self.now_s + self.dt / 1000,
+                                         self.last_unsettled_s)
+
+    # Run for as long as run_simulation does. With trace (see make_trace()), every step of every run is recorded,
+    # as run_simulation records its one run.
+    def run(self, duration_s=Course_Correction_Timeout, trace: SimulationTrace = None):
+        self.trace = trace
+        while self.runtime_s <= duration_s:
+            self.step()
+        return self.get_metrics()
+
+    # A trace with run_simulation's columns, one value per run (in the order of the runs, flattened) in each.
+    def make_trace(self, duration_s=Course_Correction_Timeout) -> SimulationTrace:
+        return SimulationTrace(("time", "pv", "err", "correction", "rudder"),
+                               capacity=int(duration_s * 1000 / self.dt) + 2, width=self.heading.size)
+
+    # Per run arrays:
+    #   final_heading, final_error_deg       where the boat ended up
+    #   settling_time_s                      time after which the error stayed within the tolerance; inf if it never did
+    #   overshoot_deg, iae                   furthest past the target, and the integral of the absolute error
+    #   rudder_travel_deg, max_rudder_deg    how hard the rudder was worked
+    def get_metrics(self) -> dict:
+        final_error = calculate_angle_differences(self.target_value, self.heading)
+        settled = (np.abs(final_error) <= self.settled_tolerance_deg) & (self.last_unsettled_s < self.now_s)
+        return dict(final_heading=self.heading,
+                    final_error_deg=final_error,
+                    settling_time_s=np.where(settled, self.last_unsettled_s, np.inf),
+                    overshoot_deg=self.overshoot_deg,
+                    iae=self.iae,
+                    rudder_travel_deg=self.rudder_travel_deg,
+                    max_rudder_deg=self.max_rudder_deg)
+
+
+# Simulate every combination of p_gains x i_gains x d_gains, turning from initial_heading to target_value on the
+# boat described by boat_config. Returns the gains, flattened, and the metrics for each.
+def run_batch_simulation(target_value, p_gains, i_gains, d_gains, boat_config, initial_heading,
+                         duration_s=Course_Correction_Timeout):
+    p, i, d = (a.ravel() for a in np.meshgrid(p_gains, i_gains, d_gains, indexing='ij'))
+    simulation = BatchSimulation(p, i, d, initial_heading, target_value,
+                                 boat_config.get_max_rudder_deflection_deg(), boat_config.get_rudder_speed_dps(),
+                                 boat_config.get_boat_turn_rate_dps(), boat_config.get_sampling_interval_ms())
+    return (p, i, d), simulation.run(duration_s)
+
+
+def parse_range(text):
+    start, stop, count = text.split(':')
+    return np.linspace(float(start), float(stop), int(count))
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    target_value = 100.0
+    initial_heading = 200.0
+    boat_config = BoatConfig(args[0])
+    start_s = real_time.perf_counter()
+    (p, i, d), metrics = run_batch_simulation(target_value, parse_range(args[1]), parse_range(args[2]),
+                                              parse_range(args[3]), boat_config, initial_heading)
+    elapsed_s = real_time.perf_counter() - start_s
+    print(f"Simulated {len(p)} runs of {Course_Correction_Timeout}s in {elapsed_s:.2f}s ({1e6 * elapsed_s / len(p):.1f} us/run)")
+    # Best first: settled soonest, then least overshoot
+    order = np.lexsort((metrics['overshoot_deg'], metrics['iae'], metrics['settling_time_s']))
+    print(f"{'P':>10} {'I':>10} {'D':>10} {'settle s':>9} {'overshoot':>9} {'IAE':>9} {'error':>7} {'rudder':>7}")
+    for n in order[:10]:
+        print(f"{p[n]:10.6f} {i[n]:10.6f} {d[n]:10.6f} {metrics['settling_time_s'][n]:9.1f} {metrics['overshoot_deg'][n]:9.2f} "
+              f"{metrics['iae'][n]:9.1f} {metrics['final_error_deg'][n]:7.2f} {metrics['rudder_travel_deg'][n]:7.1f}")
@@ -0,0 +1,233 @@
+# Author: Adrian Vrouwenvelder
+#
+# Searches for the PID gains that steer best in simulation, per sea state, with a genetic algorithm, and writes them
+# into config.yaml's gains: section, where Config.get_gain() finds them.
+#
+# Each generation's candidates are scored by batch_simulator.py (the same boat and PID as run_simulation) on every
+# course change in gain_optimizer: course_changes, in the sea state's waves (at several phases), and the score is
+# averaged. The population is split across a process pool, one batch simulation per core.
+# After every generation the search is checkpointed, so an interrupted search can be picked up with --resume.
+#
+# Run alongside simulator.py:
+#   python3 gain_optimizer.py ../configuration/config.yaml                          # All sea states
+#   python3 gain_optimizer.py ../configuration/config.yaml --sea-state rough --resume --write
+
+import argparse
+import os
+import pickle
+import time as real_time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import yaml
+
+from config import Config as BoatConfig
+from batch_simulator import BatchSimulation, Course_Correction_Timeout
+
+GAINS = ('P', 'I', 'D')
+WAVE_PHASES = 4  # Wave phases each course change is scored at, when there are waves
+ELITES = 2  # Best candidates carried into the next generation unchanged
+TOURNAMENT_SIZE = 3
+MUTATION_RATE = 0.3  # Chance of each gain of a child being mutated
+MUTATION_SCALE = 0.1  # Standard deviation of a mutation, as a fraction of the gain's range
+
+
+# Everything a worker needs to score candidates in one sea state. Picklable, to send to the process pool.
+class SeaState:
+
+    def __init__(self, name, settings, boat_config: BoatConfig):
+        sea_state = settings['sea_states'][name]
+        self.name = name
+        self.max_rudder_deflection_deg = float(sea_state.get('max_rudder_deflection', boat_config.get_max_rudder_deflection_deg()))
+        self.rudder_speed_dps = float(sea_state.get('rudder_speed', boat_config.get_rudder_speed_dps()))
+        self.max_boat_turn_rate_dps = float(sea_state.get('boat_turn_rate', boat_config.get_boat_turn_rate_dps()))
+        self.sampling_interval_ms = boat_config.get_sampling_interval_ms()
+        self.wave_yaw_dps = float(sea_state['wave_yaw'])
+        self.wave_period_s = float(sea_state['wave_period'])
+        self.overshoot_weight = float(settings['overshoot_weight'])
+        self.rudder_weight = float(settings['rudder_weight'])
+        # Scenarios: every course change at every wave phase
+        phases = np.arange(WAVE_PHASES) * 2 * np.pi / WAVE_PHASES if self.wave_yaw_dps != 0 else np.zeros(1)
+        course_changes = np.array(settings['course_changes'], dtype=float)
+        self.initial_headings = np.repeat(course_changes[:, 0], len(phases))
+        self.target_values = np.repeat(course_changes[:, 1], len(phases))
+        self.wave_phases = np.tile(phases, len(course_changes))
+
+    # Score each row of gains (n x 3) on every scenario. Returns the n mean scores; lower is better.
+    def score(self, gains):
+        gains = np.asarray(gains, dtype=float)
+        if len(gains) == 0:
+            return np.zeros(0)
+        simulation = BatchSimulation(gains[:, 0:1], gains[:, 1:2], gains[:, 2:3],
+                                     self.initial_headings, self.target_values,
+                                     self.max_rudder_deflection_deg, self.rudder_speed_dps, self.max_boat_turn_rate_dps,
+                                     self.sampling_interval_ms, wave_yaw_dps=self.wave_yaw_dps,
+                                     wave_period_s=self.wave_period_s, wave_phase=self.wave_phases)
+        metrics = simulation.run(Course_Correction_Timeout)
+        scores = metrics['iae'] + self.overshoot_weight * metrics['overshoot_deg'] + self.rudder_weight * metrics['rudder_travel_deg']
+        return scores.mean(axis=1)
+
+
+# Runs in the pool's worker processes.
+def score_gains(sea_state: SeaState, gains):
+    return sea_state.score(gains)
+
+
+# The state of a search, as checkpointed after each generation.
+class Search:
+
+    def __init__(self, sea_state_name, bounds, population_size, seed, initial_gains=None):
+        self.sea_state_name = sea_state_name
+        self.lower = np.array([bounds[gain][0] for gain in GAINS], dtype=float)
+        self.upper = np.array([bounds[gain][1] for gain in GAINS], dtype=float)
+        self.rng = np.random.default_rng(seed)
+        self.population = self.lower + self.rng.random((population_size, len(GAINS))) * (self.upper - self.lower)
+        if initial_gains is not None:
+            # Start from the gains in use, so that the search can only improve on them.
+            self.population[0] = np.clip(initial_gains, self.lower, self.upper)
+        self.generation = 0
+        self.best_gains = None
+        self.best_score = np.inf
+        self.history = []  # Best score of each generation
+
+    # Record the scores of the current population, and breed the next one from it.
+    def advance(self, scores):
+        order = np.argsort(scores)
+        if scores[order[0]] < self.best_score:
+            self.best_score = float(scores[order[0]])
+            self.best_gains = self.population[order[0]].copy()
+        self.history.append(float(scores[order[0]]))
+        population = self.population
+        children = [population[n] for n in order[:ELITES]]
+        span = self.upper - self.lower
+        while len(children) < len(population):
+            parent_a = population[self._tournament(scores)]
+            parent_b = population[self._tournament(scores)]
+            # Blend crossover: anywhere on the line through the parents, a little beyond them either side
+            mix = self.rng.uniform(-0.25, 1.25, len(GAINS))
+            child = parent_a + mix * (parent_b - parent_a)
+            mutate = self.rng.random(len(GAINS)) < MUTATION_RATE
+            child = child + mutate * self.rng.normal(0, MUTATION_SCALE, len(GAINS)) * span
+            children.append(np.clip(child, self.lower, self.upper))
+        self.population = np.array(children)
+        self.generation += 1
+
+    def _tournament(self, scores):
+        entrants = self.rng.integers(0, len(scores), TOURNAMENT_SIZE)
+        return entrants[np.argmin(scores[entrants])]
+
+    def save(self, checkpoint_file):
+        temp_file = checkpoint_file + ".tmp"
+        with open(temp_file, 'wb') as stream:
+            pickle.dump(self, stream)
+        os.replace(temp_file, checkpoint_file)  # All or nothing, even if interrupted while saving
+
+    @staticmethod
+    def load(checkpoint_file):
+        with open(checkpoint_file, 'rb') as stream:
+            return pickle.load(stream)
+
+
+def optimize(sea_state: SeaState, search: Search, generations, checkpoint_file, executor: ProcessPoolExecutor, workers):
+    while search.generation < generations:
+        start_s = real_time.perf_counter()
+        chunks = np.array_split(search.population, workers)
+        scores = np.concatenate(list(executor.map(score_gains, [sea_state] * len(chunks), chunks)))
+        search.advance(scores)
+        search.save(checkpoint_file)
+        p, i, d = search.best_gains
+        print(f"{sea_state.name}: generation {search.generation}/{generations}: best score {search.best_score:.1f} "
+              f"(P {p:.6f} I {i:.8f} D {d:.6f}) in {real_time.perf_counter() - start_s:.2f}s")
+    return search.best_gains, search.best_score
+
+
+# Put the gains for sea_state into the gains: section of config_file, replacing its P, I and D (or adding the sea
+# state, after the others). Edits just those lines, so comments, and the gains tried before, are kept.
+def write_gains(config_file, sea_state, gains, comment):
+    with open(config_file, 'r') as stream:
+        lines = stream.read().split('\n')
+    gain_lines = {gain: f"    {gain}: {value}" for gain, value in zip(GAINS, gains)}
+    section = None
+    state_start = gains_end = None
+    state_end = None
+    for n, line in enumerate(lines):
+        if line.strip() == '' or line.lstrip().startswith('#'):
+            continue
+        indent = len(line) - len(line.lstrip())
+        if indent == 0:
+            if section == 'gains':
+                gains_end = n
+            section = line.split(':')[0]
+        elif section == 'gains' and indent == 2:
+            if line.strip().split(':')[0] == sea_state:
+                state_start = n
+            elif state_start is not None and state_end is None:
+                state_end = n
+    if gains_end is None:
+        if section != 'gains':
+            raise Exception(f"No gains: section in {config_file}")
+        gains_end = len(lines)
+    if state_start is None:
+        while gains_end > 0 and lines[gains_end - 1].strip() == '':
+            gains_end -= 1
+        lines[gains_end:gains_end] = [f"  {sea_state}:", f"    # {comment}"] + list(gain_lines.values())
+    else:
+        if state_end is None:
+            state_end = gains_end
+        gain_line_numbers = [n for n in range(state_start + 1, state_end)
+                             if lines[n].strip().split(':')[0] in gain_lines and not lines[n].lstrip().startswith('#')]
+        for n in gain_line_numbers:
+            lines[n] = gain_lines[lines[n].strip().split(':')[0]]
+        first = gain_line_numbers[0]
+        if lines[first - 1].strip().startswith("# gain_optimizer.py"):
+            lines[first - 1] = f"    # {comment}"
+        else:
+            lines.insert(first, f"    # {comment}")
+    with open(config_file, 'w') as stream:
+        stream.write('\n'.join(lines))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Optimize PID gains per sea state in simulation.")
+    parser.add_argument("config", help="config.yaml to take the boat and gain_optimizer settings from")
+    parser.add_argument("--sea-state", action="append", help="Sea state to optimize (repeatable). All if not given")
+    parser.add_argument("--generations", type=int, help="Generations to run, overriding config.yaml")
+    parser.add_argument("--population", type=int, help="Candidates per generation, overriding config.yaml")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Processes to score candidates in")
+    parser.add_argument("--seed", type=int, help="Random seed, for a repeatable search")
+    parser.add_argument("--checkpoint-dir", default=".", help="Where to keep gain_optimizer_<sea state>.checkpoint")
+    parser.add_argument("--resume", action="store_true", help="Pick up from the checkpoint, if there is one")
+    parser.add_argument("--write", action="store_true", help="Write the best gains into config.yaml")
+    args = parser.parse_args()
+
+    boat_config = BoatConfig(args.config)
+    with open(args.config, 'r') as stream:
+        config = yaml.safe_load(stream)
+    settings = config['gain_optimizer']
+    generations = args.generations or settings['generations']
+    population_size = args.population or settings['population']
+    results = {}
+    # Each sea state's search gets a seed of its own, derived from --seed (and its place in config.yaml, so that it
+    # is the same whichever sea states are run), so that the searches do not all start from the same population.
+    sea_state_names = list(settings['sea_states'])
+    seeds = np.random.SeedSequence(args.seed).spawn(len(sea_state_names))
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for name in args.sea_state or sea_state_names:
+            sea_state = SeaState(name, settings, boat_config)
+            checkpoint_file = os.path.join(args.checkpoint_dir, f"gain_optimizer_{name}.checkpoint")
+            if args.resume and os.path.exists(checkpoint_file):
+                search = Search.load(checkpoint_file)
+                print(f"{name}: resuming from generation {search.generation} of {checkpoint_file}")
+            else:
+                gains = config['gains'].get(name, config['gains']['default'])
+                search = Search(name, settings['bounds'], population_size, seeds[sea_state_names.index(name)],
+                                [gains[gain] for gain in GAINS])
+            results[name] = optimize(sea_state, search, generations, checkpoint_file, executor, args.workers)
+
+    for name, (gains, score) in results.items():
+        print(f"{name}: " + " ".join(f"{gain}: {value}" for gain, value in zip(GAINS, gains)) + f" (score {score:.1f})")
+        if args.write:
+            write_gains(args.config, name, [float(value) for value in gains],
+                        f"gain_optimizer.py {real_time.strftime('%Y-%m-%d')}: score {score:.1f}")
+    if args.write:
+        print(f"Written to {args.config}")
@@ -0,0 +1,316 @@
+## Adrian Vrouwenvelder
+## April 2023
+
+# Emulates the MPU9250 and its AK8963 magnetometer at the register level, as an I2C bus (see web/modules/i2c_bus.py),
+# so that mpu9250_interface, its FIFO and DRDY handling and its monitor loop can be run, and benchmarked, without
+# the hardware:
+#   emulator = Mpu9250Emulator(SyntheticMotion())
+#   imu = mpu9250_interface(bus=1, config_file=config_file, i2c_bus=emulator)
+# Implements WHO_AM_I, PWR_MGMT_1, SMPLRT_DIV, USER_CTRL, FIFO_EN, FIFO_COUNT, FIFO_R_W and the accel, temp and
+# gyro data registers of the MPU9250, and WIA, CNTL1, ST1, the data registers and ST2 of the AK8963.
+# Readings come from a motion source: SyntheticMotion, or RecordedMotion (a debugmpu.py CSV).
+# Every transaction can be given a latency, to stand in for the real bus.
+#
+# Run this file to benchmark the driver against the emulator:
+#   PYTHONPATH=../web python3 mpu9250Emulator.py --help
+
+import argparse
+import math
+import os
+import random
+import struct
+import tempfile
+import threading
+import time
+
+import yaml
+
+from modules.mpu9250Interface import *
+
+MAG_CNTL1_RATES_HZ = {MAG_CNTL1_8HZ: 8, MAG_CNTL1_100HZ: 100}
+
+
+def _rotate_y(v, angle):
+    x, y, z = v
+    c, s = math.cos(angle), math.sin(angle)
+    return (c * x + s * z, y, -s * x + c * z)
+
+
+def _rotate_z(v, angle):
+    x, y, z = v
+    c, s = math.cos(angle), math.sin(angle)
+    return (c * x - s * y, s * x + c * y, z)
+
+
+# A boat turning steadily at turn_rate (dps) from heading (degrees), rolling heel_amplitude (degrees) either side
+# of heel (degrees) every roll_period seconds. Returns (accel Gs, gyro dps, mag uT, temp C) at time t (seconds), as
+# a perfect sensor (plus noise) would read them: the mag in the AK8963's own frame, the rest in the MPU9250's.
+# The earth's field is such that mpu9250_interface, with neutral calibration, reads the heading given here.
+class SyntheticMotion:
+
+    def __init__(self, heading=0.0, turn_rate=3.0, heel=10.0, heel_amplitude=5.0, roll_period=4.0,
+                 field=(0.0, -20.0, -45.0), temp=25.0, gyro_bias=(0.0, 0.0, 0.0), noise=0.01):
+        self.heading = heading
+        self.turn_rate = turn_rate
+        self.heel = heel
+        self.heel_amplitude = heel_amplitude
+        self.roll_period = roll_period
+        self.field = field
+        self.temp = temp
+        self.gyro_bias = gyro_bias
+        self.noise = noise
+        self._random = random.Random(0)
+
+    def get_heading(self, t):
+        return (self.heading + self.turn_rate * t) % 360
+
+    def get_heel(self, t):
+        return self.heel + self.heel_amplitude * math.sin(2 * math.pi * t / self.roll_period)
+
+    def __call__(self, t):
+        psi = math.radians(self.heading + self.turn_rate * t)
+        phi = math.radians(self.get_heel(t))
+        heel_rate = self.heel_amplitude * 2 * math.pi / self.roll_period * math.cos(2 * math.pi * t / self.roll_period)
+        noise = lambda scale: self._random.gauss(0, self.noise * scale)
+        accel = _rotate_y(_rotate_z((0.0, 0.0, 1.0), psi), phi)
+        # Body rates of a sensor rolled about Y by phi after turning about Z by psi
+        up_turn = _rotate_y((0.0, 0.0, self.turn_rate), phi)
+        gyro = tuple(-rate - (heel_rate if axis == 1 else 0) + bias + noise(10)
+                     for axis, (rate, bias) in enumerate(zip(up_turn, self.gyro_bias)))
+        mag = _rotate_y(_rotate_z(self.field, psi), phi)
+        return (tuple(a + noise(1) for a in accel), gyro,
+                (mag[1] + noise(100), mag[0] + noise(100), -mag[2] + noise(100)), self.temp)
+
+
+# Readings replayed from a CSV written by web/modules/calibration/debugmpu.py (time ms, gyro, mag, accel, compass),
+# looping at the end.
+class RecordedMotion:
+
+    def __init__(self, csv_file, temp=25.0):
+        self.temp = temp
+        self._rows = []
+        with open(csv_file, 'r') as stream:
+            for line in stream:
+                fields = line.split(',')
+                try:
+                    values = [float(field) for field in fields[:10]]
+                except ValueError:
+                    continue  # Headers and messages
+                if len(values) == 10:
+                    self._rows.append(values)
+        if len(self._rows) < 2:
+            raise Exception(f"No readings in {csv_file}")
+        self._duration_s = self._rows[-1][0] / 1000
+
+    def __call__(self, t):
+        t_ms = (t % self._duration_s) * 1000
+        # Rows are in time order, a few ms apart: binary search for the last one at or before t.
+        low, high = 0, len(self._rows) - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self._rows[middle][0] <= t_ms:
+                low = middle
+            else:
+                high = middle - 1
+        row = self._rows[low]
+        return tuple(row[7:10]), tuple(row[1:4]), tuple(row[4:7]), self.temp
+
+
+def _to_short(value):
+    return max(-32768, min(32767, int(round(value))))
+
+
+class Mpu9250Emulator:
+
+    # latency_s: time each transaction takes. burst_read: whether read_burst works (the Pi's adapter allows it).
+    def __init__(self, motion=None, latency_s=0.0, burst_read=True, clock=time.monotonic):
+        self.motion = SyntheticMotion() if motion is None else motion
+        self.latency_s = latency_s
+        self.burst_read = burst_read
+        self._clock = clock
+        self._start_s = clock()
+        self._lock = threading.Lock()
+        self._mpu = bytearray(128)
+        self._mpu[MPU9250_WHO_AM_I_REG] = MPU9250_DEVICE_ID
+        self._ak = bytearray(32)
+        self._ak[AK8963_WHO_AM_I_REG] = AK8963_DEVICE_ID
+        self._fifo = bytearray()
+        self._fifo_start_s = None
+        self._fifo_samples = 0  # Samples put in the FIFO since it was last reset
+        self._mag_start_s = None
+        self._mag_rate_hz = 0
+        self._mag_released = 0  # Measurements taken by the last time the data registers were read through ST2
+        self.transactions = 0
+
+    def _transaction(self):
+        self.transactions += 1
+        if self.latency_s > 0:
+            time.sleep(self.latency_s)
+
+    def _reading_at(self, t_s):
+        return self.motion(t_s - self._start_s)
+
+    @staticmethod
+    def _accel_temp_gyro_block(reading) -> bytes:
+        accel, gyro, _, temp = reading
+        return ACCEL_TEMP_GYRO_STRUCT.pack(*(_to_short(a / ACCEL_RANGE_CONV) for a in accel),
+                                           _to_short((temp - 21.0) * TEMP_SENSITIVITY + ROOM_TEMP_OFFSET),
+                                           *(_to_short(g / GYRO_RANGE_CONV) for g in gyro))
+
+    # Put the samples due by now_s into the FIFO, at the rate SMPLRT_DIV gives, overwriting the oldest when full.
+    def _fill_fifo(self, now_s):
+        if self._fifo_start_s is None or not self._mpu[FIFO_EN_REG]:
+            return
+        period_s = (1 + self._mpu[SMPLRT_DIV_REG]) / INTERNAL_SAMPLE_RATE_HZ
+        due = int((now_s - self._fifo_start_s) / period_s)
+        # No more than a FIFO's worth can survive, so skip any older ones.
+        self._fifo_samples = max(self._fifo_samples, due - FIFO_SIZE // FIFO_RECORD_SIZE - 1)
+        while self._fifo_samples < due:
+            self._fifo_samples += 1
+            self._fifo += self._accel_temp_gyro_block(self._reading_at(self._fifo_start_s + self._fifo_samples * period_s))
+        if len(self._fifo) > FIFO_SIZE:
+            del self._fifo[:len(self._fifo) - FIFO_SIZE]
+
+    def _mag_measurements(self, now_s) -> int:
+        if self._mag_start_s is None:
+            return 0
+        return int((now_s - self._mag_start_s) * self._mag_rate_hz)
+
+    def read_byte_data(self, address, register) -> int:
+        return self.read_i2c_block_data(address, register, 1)[0]
+
+    def write_byte_data(self, address, register, value):
+        with self._lock:
+            self._transaction()
+            now_s = self._clock()
+            if address == MPU9250_ADDRESS:
+                self._fill_fifo(now_s)
+                self._mpu[register] = value
+                if register == USER_CTRL_REG:
+                    if value & USER_CTRL_FIFO_RST:
+                        self._fifo.clear()
+                        self._fifo_samples = 0
+                        self._fifo_start_s = now_s
+                    if not value & USER_CTRL_FIFO_EN:
+                        self._fifo_start_s = None
+                    elif self._fifo_start_s is None:
+                        self._fifo_start_s = now_s
+                        self._fifo_samples = 0
+            elif address == AK8963_ADDRESS:
+                self._ak[register] = value
+                if register == MAG_CNTL1_REG:
+                    self._mag_rate_hz = MAG_CNTL1_RATES_HZ.get(value & 0x0F, 0)
+                    self._mag_start_s = now_s if self._mag_rate_hz > 0 else None
+                    self._mag_released = 0
+            else:
+                raise OSError(f"No device at 0x{address:02x}")
+
+    def read_i2c_block_data(self, address, register, length) -> list:
+        if length > SMBUS_BLOCK_MAX:
+            raise ValueError(f"Block reads are limited to {SMBUS_BLOCK_MAX} bytes")
+        return list(self._read(address, register, length))
+
+    def read_burst(self, address, register, length) -> bytes:
+        if not self.burst_read:
+            raise OSError("Emulated adapter does not support combined transactions")
+        return self._read(address, register, length)
+
+    def _read(self, address, register, length) -> bytes:
+        with self._lock:
+            self._transaction()
+            now_s = self._clock()
+            if address == MPU9250_ADDRESS:
+                self._fill_fifo(now_s)
+                if register == FIFO_R_W_REG:
+                    data = bytes(self._fifo[:length])
+                    del self._fifo[:length]
+                    return data.ljust(length, b'\0')
+                self._mpu[ACCEL_DATA_REG:ACCEL_DATA_REG + ACCEL_TEMP_GYRO_BLOCK_SIZE] = \
+                    self._accel_temp_gyro_block(self._reading_at(now_s))
+                self._mpu[FIFO_COUNTH_REG:FIFO_COUNTH_REG + 2] = struct.pack('>H', len(self._fifo))
+                return bytes(self._mpu[register:register + length])
+            if address == AK8963_ADDRESS:
+                taken = self._mag_measurements(now_s)
+                if taken > 0:
+                    mag_s = self._mag_start_s + taken / self._mag_rate_hz
+                    st1 = (MAG_ST1_DRDY if taken > self._mag_released else 0) | \
+                          (MAG_ST1_DOR if taken > self._mag_released + 1 else 0)
+                    mx, my, mz = self._reading_at(mag_s)[2]
+                    self._ak[MAG_ST1_REG:MAG_ST2_REG + 1] = MAG_ST1_ST2_STRUCT.pack(
+                        st1, _to_short(mx / MAG_RANGE_CONV), _to_short(my / MAG_RANGE_CONV), _to_short(mz / MAG_RANGE_CONV), 0)
+                data = bytes(self._ak[register:register + length])
+                if register <= MAG_ST2_REG < register + length:  # Reading ST2 releases the data for the next measurement
+                    self._mag_released = taken
+                return data
+            raise OSError(f"No device at 0x{address:02x}")
+
+    def close(self):
+        pass
+
+
+################################################################################
+# Benchmark mpu9250_interface against the emulator.
+def benchmark(config_file, seconds, fifo, rate_hz, drain_interval_ms, latency_s, burst_read, csv_file, record_file=None):
+    with open(config_file, 'r') as stream:
+        config = yaml.safe_load(stream)
+    mpu = config['mpu9250']
+    mpu['sample_rate'] = rate_hz
+    mpu['fifo'].update(enabled=fifo, odr=rate_hz, drain_interval=drain_interval_ms, burst_read=burst_read)
+    # Neutral calibration, so that the driver's heading can be compared with the motion's.
+    mpu['gyro']['bias'] = [0.0, 0.0, 0.0]
+    mpu['gyro']['bias_estimation']['enabled'] = False
+    mpu['accel']['bias'] = [0.0, 0.0, 0.0]
+    mpu['temp']['bias'] = 0
+    mpu['mag'] = dict(mpu['mag'], calib=[1.0, 1.0, 1.0], bias=[0.0, 0.0, 0.0], scale=[1.0, 1.0, 1.0])
+    mpu['mag'].pop('hard_iron', None)
+    mpu['mag'].pop('soft_iron', None)
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as stream:
+        yaml.safe_dump(config, stream)
+        benchmark_config_file = stream.name
+
+    motion = RecordedMotion(csv_file) if csv_file else SyntheticMotion()
+    emulator = Mpu9250Emulator(motion, latency_s=latency_s, burst_read=burst_read)
+    try:
+        imu = get_interface(config_file=benchmark_config_file, i2c_bus=emulator)
+    finally:
+        os.remove(benchmark_config_file)
+    if record_file:
+        imu.start_recording(record_file)
+    imu.start()
+    time.sleep(seconds)
+    sample = imu.get_sample()
+    imu.stop()
+    imu.stop_recording()
+    stats = imu.get_stats()
+    monitor = stats.pop('monitor')
+    print(f"Driver: {stats}")
+    print(f"Monitor loop: {monitor}")
+    print(f"Emulated transactions: {emulator.transactions / seconds:.1f}/s")
+    if isinstance(motion, SyntheticMotion):
+        t = sample.timestamp - emulator._start_s
+        print(f"Heading {sample.heading:.1f} (motion {motion.get_heading(t):.1f}), "
+              f"heel {sample.heel:.1f} (motion {motion.get_heel(t):.1f}), yaw rate {sample.yaw_rate:.2f} (motion {motion.turn_rate:.2f})")
+
+    # Decode throughput, without the bus
+    data = b''.join(Mpu9250Emulator._accel_temp_gyro_block(motion(k / 100)) for k in range(1000))
+    start_s = time.perf_counter()
+    for _ in range(100):
+        decode_accel_temp_gyro_batch(data)
+    print(f"Batch decode: {(time.perf_counter() - start_s) / 100000 * 1e6:.2f} us/sample")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark mpu9250_interface against an emulated MPU9250.")
+    parser.add_argument("--config", default=os.path.join(os.path.dirname(__file__), "../configuration/config.yaml"),
+                        help="config.yaml to take the mpu9250 settings from")
+    parser.add_argument("--seconds", type=float, default=5.0, help="Seconds to run the driver for")
+    parser.add_argument("--fifo", action="store_true", help="Use FIFO mode")
+    parser.add_argument("--rate", type=int, default=100, help="Sample rate (register mode) or FIFO ODR, in Hz")
+    parser.add_argument("--drain-interval", type=int, default=50, help="FIFO mode: ms between FIFO drains")
+    parser.add_argument("--latency", type=float, default=0.0002, help="Seconds each I2C transaction takes")
+    parser.add_argument("--no-burst", action="store_true", help="Emulate an adapter that cannot do burst reads")
+    parser.add_argument("--csv", help="Replay this debugmpu.py CSV, rather than synthetic motion")
+    parser.add_argument("--record", help="Record the driver's register reads to this file, for imuReplayInterface.py")
+    args = parser.parse_args()
+    benchmark(args.config, args.seconds, args.fifo, args.rate, args.drain_interval, args.latency, not args.no_burst,
+              args.csv, args.record)
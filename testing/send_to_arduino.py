@@ -23,6 +23,7 @@ if __name__ == '__main__':
         print('  lnnnn: Left limit. 0000 <= nnnn <= 9999')
         print('  rnnnn: Right limit. 0000 <= nnnn <= 9999')
         print('  innnn: Status interval (ms). i0010 means 10ms.')
+        print('  fn: Status format. n=0:one line per value; n=1:one compact line')
         try:
             while True:
                 dev_arduino.write((input("Enter command: ") + "\n").encode())
@@ -0,0 +1,78 @@
+# Author: Adrian Vrouwenvelder
+#
+# Records a simulation's values, one row per step, into preallocated NumPy columns, rather than formatting each step
+# into a CSV row or appending to Python lists. Nothing is formatted until the run is over: then the trace is saved as
+# a compressed .npz (load() reads it back), exported to CSV if wanted, or plotted straight from the columns.
+#
+# A column holds one value per step, or, with width, one value per step for each of width runs (see
+# batch_simulator.py). Columns grow (doubling) if a run outlasts the capacity given.
+
+import numpy as np
+
+
+class SimulationTrace:
+
+    def __init__(self, names, capacity=1024, width=None, **metadata):
+        self.names = tuple(names)
+        self.width = width
+        self.metadata = metadata  # Values that are the same for every step, saved alongside the columns
+        shape = (capacity,) if width is None else (capacity, width)
+        self._columns = {name: np.empty(shape) for name in self.names}
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    # One step: a value (or, with width, an array of width values) for each column, in the order of names.
+    def append(self, *values):
+        n = self._length
+        if n == len(self._columns[self.names[0]]):
+            self._grow()
+        for column, value in zip(self._columns.values(), values):
+            column[n] = value
+        self._length = n + 1
+
+    def _grow(self):
+        for name, column in self._columns.items():
+            grown = np.empty((2 * len(column),) + column.shape[1:])
+            grown[:len(column)] = column
+            self._columns[name] = grown
+
+    # The recorded steps of a column (a view: no copy).
+    def column(self, name) -> np.ndarray:
+        return self._columns[name][:self._length]
+
+    def __getitem__(self, name) -> np.ndarray:
+        return self.column(name)
+
+    def save(self, npz_file):
+        np.savez_compressed(npz_file,
+                            **{name: self.column(name) for name in self.names},
+                            **{f"meta_{key}": np.asarray(value) for key, value in self.metadata.items()})
+
+    @staticmethod
+    def load(npz_file) -> 'SimulationTrace':
+        with np.load(npz_file) as data:
+            names = [name for name in data.files if not name.startswith("meta_")]
+            metadata = {name[len("meta_"):]: data[name].item() if data[name].ndim == 0 else data[name]
+                        for name in data.files if name.startswith("meta_")}
+            columns = {name: data[name] for name in names}
+        length = len(columns[names[0]])
+        trace = SimulationTrace(names, max(length, 1), None if columns[names[0]].ndim == 1 else columns[names[0]].shape[1],
+                                **metadata)
+        for name in names:
+            trace._columns[name][:length] = columns[name]
+        trace._length = length
+        return trace
+
+    # Write the columns (one per step, so not with width) as CSV, followed by the metadata named in
+    # metadata_columns, repeated on every row. Values are formatted with fmt (one format, or one per column).
+    # header_rows (lists of strings) are written first, as they are; by default, the column names.
+    def to_csv(self, csv_file, fmt="%6.4f", header_rows=None, metadata_columns=(), newline="\n"):
+        if self.width is not None:
+            raise Exception("Only traces of single runs can be exported to CSV")
+        columns = [self.column(name) for name in self.names] + \
+                  [np.full(self._length, self.metadata[key], dtype=float) for key in metadata_columns]
+        header = newline.join(",".join(row) for row in (header_rows or [self.names + tuple(metadata_columns)]))
+        np.savetxt(csv_file, np.column_stack(columns), fmt=fmt, delimiter=',', header=header, comments='',
+                   newline=newline)
@@ -4,21 +4,27 @@ import sys
 from pid_controller import PID
 from config import Config as BoatConfig
 from boat import Boat
-from island_time import time # Make things simulate faster
+from clock import VirtualClock
+from simulation_trace import SimulationTrace
 from datetime import datetime
+import numpy as np
 
 Course_Correction_Timeout = 60
 
-def run_simulation(target_value, p_gain, i_gain, d_gain, boat, sampling_interval_ms, produce_csv = False, save_plot = False, show_plot = False):
+# Records time, heading (pv), error, PID correction and rudder angle every step, into a SimulationTrace (see
+# simulation_trace.py), which is returned. Nothing is formatted while the simulation runs: the trace is written out
+# (as .npz, and as CSV with produce_csv) and plotted once the run is over.
+def run_simulation(target_value, p_gain, i_gain, d_gain, boat, sampling_interval_ms, produce_csv = False, save_plot = False, show_plot = False, save_trace = False):
 
     def render_plot():
         import matplotlib.pyplot as plt
         logging.getLogger('matplotlib.font_manager').disabled = True
-        plt.plot(x, h, label="Heading")
-        plt.plot(x, c, label="Course")
-        plt.plot(x, e, label="Error")
-        plt.plot(x, o, label="Commanded Rudder")
-        plt.plot(x, r, label="Actual Rudder Angle")
+        x = trace["time"]
+        plt.plot(x, trace["pv"], label="Heading")
+        plt.plot(x, np.full(len(trace), pid.target_value), label="Course")
+        plt.plot(x, trace["err"], label="Error")
+        plt.plot(x, trace["correction"], label="Commanded Rudder")
+        plt.plot(x, trace["rudder"], label="Actual Rudder Angle")
         plt.plot([], [], ' ', label=f"pGain {pid.p_gain:6.4f}")
         plt.plot([], [], ' ', label=f"iGain {pid.i_gain:6.4f}")
         plt.plot([], [], ' ', label=f"dGain {pid.d_gain:6.4f}")
@@ -32,66 +38,67 @@ def run_simulation(target_value, p_gain, i_gain, d_gain, boat, sampling_interval
         plt.subplots_adjust(right=0.6)
         if save_plot: 
             plt.savefig(pltfilename)
-            logger.info(f"PNG of run in file {pltfilename}")
+            logger.info("PNG of run in file %s", pltfilename)
         if show_plot: plt.show()
-    
+
+    # Same layout as the CSV written row by row before: a row of the run's settings, the column names, then a row
+    # per step, with the settings repeated on each.
+    def write_csv():
+        settings = [target_value, initial_heading, p_gain, i_gain, d_gain, boat.max_rudder_deflection_deg, boat.rudder_speed_dps, boat.max_boat_turn_rate_dps]
+        settings_formats = ["%6.4f", "%6.4f", "%10.8f", "%10.8f", "%10.8f", "%6.4f", "%6.4f", "%6.4f"]
+        trace.to_csv(csvfilename,
+                     header_rows=[[f % v for f, v in zip(settings_formats, settings)],
+                                  ["time","pv","err","correction","rudder","heading","course","p_gain","i_gain","d_gain","max_rudder_deflection","rudder_speed","max_boat_turn_rate"]],
+                     metadata_columns=["target_value", "initial_heading", "p_gain", "i_gain", "d_gain", "max_rudder_deflection", "rudder_speed", "max_boat_turn_rate"],
+                     newline="\r\n")  # As csv.writer wrote it
+        logger.info("CSV of run in file %s", csvfilename)
+
     produce_plot = save_plot or show_plot
     current_time = datetime.now()
-    if produce_csv: 
-        import csv
-        csvfilename = f"{current_time.strftime('pid_%Y%m%d-%H%M%S.csv')}"
-        csvfile = open(csvfilename, 'w', newline='')
-    if save_plot: 
-        pltfilename = f"{current_time.strftime('pid_%Y%m%d-%H%M%S.png')}"
-    iteration = 0
+    csvfilename = f"{current_time.strftime('pid_%Y%m%d-%H%M%S.csv')}"
+    pltfilename = f"{current_time.strftime('pid_%Y%m%d-%H%M%S.png')}"
+    tracefilename = f"{current_time.strftime('pid_%Y%m%d-%H%M%S.npz')}"
+    debug = logger.isEnabledFor(logging.DEBUG)  # Skip even working out what to log, when it would not be logged
+    clock = boat.clock  # The PID waits on the boat's clock, so both move through the same (simulated) time.
     initial_heading = boat.sensor.heading
-    logger.info(f"Gains: P = {p_gain} I = {i_gain} D = {d_gain} Target = {target_value} Heading = {initial_heading}")
-    start_time = time.time()
-    if produce_csv: 
-        csvwriter = csv.writer(csvfile, delimiter=',')
-        csvwriter.writerow([f"{target_value:6.4f}",f"{initial_heading:6.4f}",f"{p_gain:10.8f}",f"{i_gain:10.8f}",f"{d_gain:10.8f}",f"{boat.max_rudder_deflection_deg:6.4f}",f"{boat.rudder_speed_dps:6.4f}",f"{boat.max_boat_turn_rate_dps:6.4f}"])
-        csvwriter.writerow(["time","pv","err","correction","rudder","heading","course","p_gain","i_gain","d_gain","max_rudder_deflection","rudder_speed","max_boat_turn_rate"])
-    if produce_plot:
-        x = []
-        c = []
-        h = []
-        e = []
-        o = []
-        r = []
-    pid = PID(p_gain, i_gain, d_gain, sampling_interval_ms)
+    logger.info("Gains: P = %s I = %s D = %s Target = %s Heading = %s", p_gain, i_gain, d_gain, target_value, initial_heading)
+    start_time = clock.time()
+    trace = SimulationTrace(("time", "pv", "err", "correction", "rudder"),
+                            capacity=int(Course_Correction_Timeout * 1000 / sampling_interval_ms) + 2,
+                            target_value=target_value, initial_heading=initial_heading,
+                            p_gain=p_gain, i_gain=i_gain, d_gain=d_gain,
+                            max_rudder_deflection=boat.max_rudder_deflection_deg, rudder_speed=boat.rudder_speed_dps,
+                            max_boat_turn_rate=boat.max_boat_turn_rate_dps)
+    pid = PID(p_gain, i_gain, d_gain, sampling_interval_ms, clock)
     pid.set_target_value(target_value) # Desired heading
     runtime = 0
     # Run as long as the error > tolerated error, and the rudder has not yet straightened out, and the procedure is not taking too long.
     while runtime <= Course_Correction_Timeout:
         pid_correction = -pid.compute_output(process_value=boat.sensor.get_heading()) # Output of comnpute_output is in same direction as error, so we must flip the sign to turn it into a correction.
-        direction = "right" if pid_correction > 0 else "left"
-        logger.debug(f"Turning {direction}; Requesting rudder angle {pid_correction} to correct from {boat.sensor.get_heading()} to {target_value}")
+        if debug:
+            logger.debug("Turning %s; Requesting rudder angle %s to correct from %s to %s", "right" if pid_correction > 0 else "left", pid_correction, boat.sensor.get_heading(), target_value)
         boat.request_rudder_angle(pid_correction)
-        timestamp = time.time() - start_time
-        if produce_csv: 
-            csvwriter.writerow([f"{timestamp:6.4f}",f"{boat.sensor.heading:6.4f}",f"{pid.err:6.4f}",f"{pid_correction:6.4f}",f"{boat.current_rudder_deflection_deg:6.4f}",f"{target_value:6.4f}",f"{initial_heading:6.4f}",f"{p_gain:6.4f}",f"{i_gain:6.4f}",f"{d_gain:6.4f}",f"{boat.max_rudder_deflection_deg:6.4f}",f"{boat.rudder_speed_dps:6.4f}",f"{boat.max_boat_turn_rate_dps:6.4f}"])
-        if produce_plot:
-            x.append(timestamp)
-            c.append(pid.target_value)
-            h.append(boat.sensor.heading)
-            e.append(pid.err)
-            o.append(pid_correction)
-            r.append(boat.current_rudder_deflection_deg)
+        timestamp = clock.time() - start_time
+        trace.append(timestamp, boat.sensor.heading, pid.err, pid_correction, boat.current_rudder_deflection_deg)
         boat.tick() 
-        logger.debug(f"time={timestamp:6.4f}, target={pid.target_value:6.4f}, pv={boat.sensor.heading:6.4f}, err={pid.err:6.4f}, output={pid_correction:6.4f}, rudder={boat.current_rudder_deflection_deg:6.4f}")
+        if debug:
+            logger.debug("time=%6.4f, target=%6.4f, pv=%6.4f, err=%6.4f, output=%6.4f, rudder=%6.4f", timestamp, pid.target_value, boat.sensor.heading, pid.err, pid_correction, boat.current_rudder_deflection_deg)
         pid.wait()
-        runtime = time.time()-start_time
+        runtime = clock.time()-start_time
 
-    if runtime > 60: logger.warning(f"Runtime exceeded {Course_Correction_Timeout} seconds.") 
-    logger.debug(f"Correction from {initial_heading:6.4f} to {target_value:6.4f} took {runtime:6.0f} seconds.")
+    if runtime > 60: logger.warning("Runtime exceeded %s seconds.", Course_Correction_Timeout)
+    logger.debug("Correction from %6.4f to %6.4f took %6.0f seconds.", initial_heading, target_value, runtime)
+    if save_trace:
+        trace.save(tracefilename)
+        logger.info("Trace of run in file %s", tracefilename)
+    if produce_csv:
+        write_csv()
     if produce_plot: 
         log_level = logger.level
         logger.setLevel(level=logging.INFO)
         render_plot()
         logger.setLevel(level=log_level)
-    if produce_csv:
-        logger.info(f"CSV of run in file {csvfilename}")
-        csvfile.close()
+    return trace
 
 if __name__ == "__main__":
     logging.basicConfig(filename="simulation.log",
@@ -109,6 +116,6 @@ if __name__ == "__main__":
     initial_heading = 200.0
     boat_config = BoatConfig("config.yaml" if len(args) == 0 else args[0])
     logger.info(f"Using configuration {boat_config.filename}")
-    boat = Boat(boat_config)
+    boat = Boat(boat_config, VirtualClock()) # Make things simulate faster
     boat.sensor.heading = initial_heading # For simulation only - normally, the sensor provides the heading 
     run_simulation(target_value, float(args[1]), float(args[2]), float(args[3]), boat, boat_config.get_sampling_interval_ms(), show_plot=True)
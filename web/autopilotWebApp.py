@@ -1,9 +1,11 @@
 ## Adrian Vrouwenvelder
 ## December 1, 2022
 ## March 2023
-from flask import Flask, jsonify, render_template
+from flask import Flask, Response, jsonify, render_template
 import logging
+import time
 from modules.brain import getInstance as get_brain
+from modules.snapshot import format_heel
 from modules.status import DISABLED as STATUS_DISABLED, ENABLED as STATUS_ENABLED
 
 app = Flask(__name__)
@@ -13,6 +15,9 @@ brain = get_brain()
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
 
+# Seconds between frames on /stream when nothing has changed, so that dead clients are noticed and dropped.
+STREAM_KEEPALIVE_S = 10
+
 print("Note: Web interface is on http://127.0.0.1:5000 (unless otherwise configured)")
 
 @app.route("/")
@@ -30,27 +35,22 @@ def set_status(newStatus: str):
         brain.set_status(STATUS_DISABLED)
     return ""
 
+# The get_ routes all read the snapshot the brain publishes every tick, rather than the sensors themselves.
 @app.route("/get_course")
 def get_course():
     global brain
-    return jsonify(course=f"{brain.get_course():03.0f}")
+    return jsonify(course=f"{brain.get_snapshot().course:03.0f}")
 
 @app.route("/get_heading")
 def get_heading():
     global brain
-    return jsonify(heading=f"{brain.get_heading():03.0f}")
+    return jsonify(heading=f"{brain.get_snapshot().heading:03.0f}")
 
 
 @app.route("/get_heel")
 def get_heel():
     global brain
-    heel = brain.get_heel()
-    heel_str = "LEVEL"
-    if heel >= 1.5:
-        heel_str = f'{heel:03.0f} STBD'
-    elif heel <= -1.5:
-        heel_str = f'{-heel:03.0f} PORT'
-    return jsonify(heel=heel_str)
+    return jsonify(heel=format_heel(brain.get_snapshot().heel))
 
 @app.route("/adjust_course/<courseAdjustment>")
 def adjust_course(courseAdjustment: str):
@@ -61,19 +61,67 @@ def adjust_course(courseAdjustment: str):
 @app.route("/get_messages")
 def get_messages():
     global brain
-    return jsonify(messages=brain.get_messages())
+    return jsonify(messages=brain.get_snapshot().messages)
 
 @app.route("/get_interface_params")
 def get_interface_params():
     global brain
-    interface = brain.get_arduino_interface()
-    return jsonify(clutch_status=interface.get_status(),
-                   starboard_limit=interface.get_stbd_limit(),
-                   port_limit=interface.get_port_limit(),
-                   motor_speed=interface.get_motor_speed(),
-                   motor_direction=interface.get_motor_direction(),
-                   rudder_position=interface.get_rudder_position(),
-                   rudder_direction=interface.get_rudder_direction())
+    snapshot = brain.get_snapshot()
+    return jsonify(clutch_status=snapshot.clutch_status,
+                   starboard_limit=snapshot.starboard_limit,
+                   port_limit=snapshot.port_limit,
+                   motor_speed=snapshot.motor_speed,
+                   motor_direction=snapshot.motor_direction,
+                   rudder_position=snapshot.rudder_position,
+                   rudder_direction=snapshot.rudder_direction)
+
+# Everything the get_ routes above return, combined into one frame. The JSON is encoded once per snapshot.
+@app.route("/get_state")
+def get_state():
+    global brain
+    return Response(brain.get_snapshot().json, mimetype="application/json")
+
+# Timing of the control loop: iterations, overruns, and jitter/latency percentiles in ms.
+@app.route("/get_control_loop_stats")
+def get_control_loop_stats():
+    global brain
+    return jsonify(**brain.get_control_loop_stats())
+
+# Counters and timings of the link to the Arduino.
+@app.route("/get_interface_stats")
+def get_interface_stats():
+    global brain
+    return jsonify(**brain.get_arduino_interface().get_stats())
+
+# IMU sampling: achieved rate, CPU use, I2C transactions, and the monitor loop's jitter/latency percentiles in ms.
+@app.route("/get_sensor_stats")
+def get_sensor_stats():
+    global brain
+    return jsonify(**brain.get_sensor_stats())
+
+# Server-Sent Events stream of state frames. Replaces polling the get_ routes, which are kept for compatibility.
+# The latest snapshot is pushed when one is published that differs from the last frame sent, but no more often
+# than every stream_interval (see config.yaml). The SSE event id is the snapshot version.
+@app.route("/stream")
+def stream():
+    global brain
+    interval_s = brain.get_config().get_stream_interval_ms() / 1000
+
+    def generate():
+        version = None
+        last_json = None
+        last_sent_s = 0
+        while True:
+            version = brain.wait_for_state_change(version, timeout=STREAM_KEEPALIVE_S)
+            snapshot = brain.get_snapshot()
+            now_s = time.monotonic()
+            if snapshot.json != last_json or now_s - last_sent_s >= STREAM_KEEPALIVE_S:
+                last_json = snapshot.json
+                last_sent_s = now_s
+                yield f"id: {snapshot.version}\ndata: {snapshot.json}\n\n"
+                time.sleep(interval_s)
+
+    return Response(generate(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 if __name__ == "__main__":
     app.run()
@@ -6,27 +6,104 @@ import threading
 import time
 from modules.status import ENABLED as STATUS_ENABLED, DISABLED as STATUS_DISABLED
 
-# Called asynchronously from ArduinoInterface
+# Motor directions, as used by the Arduino's 'd' command and 'd=' report.
+MOTOR_NEITHER = 0
+MOTOR_LEFT = 1
+MOTOR_RIGHT = 2
+
+# Seconds a sent motor command is assumed to be on its way, before the Arduino's report of the value is believed
+# instead. Repeating the command is only suppressed while it is pending, or if the Arduino has reported the value
+# since the command was sent.
+PENDING_COMMAND_TIMEOUT_S = 0.5
+
+def _text(value: bytes) -> str:
+    return value.decode('utf-8', errors='replace').strip()
+
+# Lines from the Arduino are "<letter>=<value>". Table of letter (as a byte) -> (interface attribute, value parser).
+# int() accepts bytes and ignores surrounding whitespace (e.g. the '\r' of '\r\n'), so values are never decoded.
+_FIELDS = {
+    ord('m'): ('_messages', _text),  # Text message
+    ord('r'): ('_stbd_limit', int),  # Right limit
+    ord('l'): ('_port_limit', int),  # Left limit
+    ord('s'): ('_motor_speed', int),  # Motor speed
+    ord('d'): ('_motor_direction', int),  # Motor direction
+    ord('p'): ('_rudder_position', int),  # Rudder position magnitude
+    ord('x'): ('_rudder_direction', int),  # Rudder position direction
+    ord('c'): ('_clutch_status', int),  # Clutch status
+}
+_EQUALS = ord('=')
+_LAST_STATUS_FIELD = ord('x')  # Last line of a status report (see reportStatus in adrianAutoPilot.ino)
+
+# Compact status report (see reportCompactStatus in adrianAutoPilot.ino): one fixed-layout line carrying every value.
+# z=CLLLLRRRRSSSDPPPPX*HH
+# Table of interface attribute -> (start, end) of the value within the line.
+_COMPACT_STATUS = ord('z')
+_COMPACT_FIELDS = (
+    ('_clutch_status', 2, 3),
+    ('_port_limit', 3, 7),
+    ('_stbd_limit', 7, 11),
+    ('_motor_speed', 11, 14),
+    ('_motor_direction', 14, 15),
+    ('_rudder_position', 15, 19),
+    ('_rudder_direction', 19, 20),
+)
+_COMPACT_CHECKSUM_SEPARATOR = ord('*')
+_COMPACT_LENGTH = 23  # Not counting line termination
+
+# Decode a compact status line into fields. Returns False (and leaves fields alone) if the line is damaged.
+def _decode_compact_status(line: bytes, fields: dict) -> bool:
+    if line.endswith(b'\r'):  # Left over from '\r\n'
+        line = line[:-1]
+    if len(line) != _COMPACT_LENGTH or line[20] != _COMPACT_CHECKSUM_SEPARATOR:
+        return False
+    checksum = 0
+    for c in line[2:20]:
+        checksum ^= c
+    try:
+        if checksum != int(line[21:23], 16):
+            return False
+        values = [(name, int(line[start:end])) for name, start, end in _COMPACT_FIELDS]
+    except ValueError:
+        return False
+    fields.update(values)
+    return True
+
+# Called asynchronously from ArduinoInterface, with a batch of raw lines (bytes) as read from the Arduino.
+# All lines are parsed first and then applied in one go, so readers never see half of a status report.
+# Lines that cannot be parsed are counted (see get_parse_errors), and the latest one is shown as the message.
+# Complete status reports are counted too: each compact line, and each x= line (the last of a verbose report).
+def apply_arduino_lines(interface, lines):
+    fields = {}
+    errors = 0
+    reports = 0
+    for line in lines:
+        if len(line) < 2:  # Blank line, or the '\r' left over from '\r\n'
+            continue
+        if line[0] == _COMPACT_STATUS and line[1] == _EQUALS and _decode_compact_status(line, fields):
+            reports += 1
+            continue
+        field = _FIELDS.get(line[0]) if line[1] == _EQUALS else None
+        if field is not None:
+            try:
+                fields[field[0]] = field[1](line[2:])
+                if line[0] == _LAST_STATUS_FIELD:
+                    reports += 1
+                continue
+            except ValueError:
+                pass
+        errors += 1
+        fields['_messages'] = f"Unsupported message `{_text(line)}`"
+    now_s = time.monotonic()
+    for name, value in fields.items():
+        setattr(interface, name, value)
+        if name != '_messages':
+            interface._reported_at[name] = now_s
+    interface._parse_errors += errors
+    interface._reports_applied += reports
+
+# Called asynchronously from ArduinoInterface, with a single line of text.
 def from_arduino(interface, msg):
-    if msg.startswith('m='):  # Text message
-        interface._messages = msg[2:]
-    elif msg.startswith('r='):  # Right limit
-        interface._stbd_limit = int(msg[2:])
-    elif msg.startswith('l='):  # Left limit
-        interface._port_limit = int(msg[2:])
-    elif msg.startswith('s='):  # Motor speed
-        interface._motor_speed = int(msg[2:])
-    elif msg.startswith('d='):  # Motor direction
-        interface._motor_direction = int(msg[2:])
-    elif msg.startswith('p='):  # Rudder position magnitude
-        interface._rudder_position = int(msg[2:])
-    elif msg.startswith('x='):  # Rudder position direction
-        interface._rudder_direction = int(msg[2:])
-    elif msg.startswith('c='):  # Rudder position direction
-        interface._clutch_status = int(msg[2:])
-    else:
-        print(f"Unsupported message {msg}")
-        interface._messages = f"Unsupported message `{msg}`"
+    apply_arduino_lines(interface, [msg.encode()])
 
 # Private
 class ArduinoInterface():
@@ -47,6 +124,12 @@ class ArduinoInterface():
         self._motor_speed = 0
         self._motor_direction = 0
         self._clutch_status = 0
+        self._parse_errors = 0
+        self._reports_applied = 0
+        self._reported_at = {}  # interface attribute -> time.monotonic() at which the Arduino last reported it
+        self._pending_commands = {}  # command letter -> (value, time sent) of the latest motor commands sent
+        self._commands_sent = 0
+        self._commands_suppressed = 0
 
     def start(self):
         self._running = True
@@ -69,16 +152,38 @@ class ArduinoInterface():
     def set_status(self, status: int):
         self.write(f"c{status}")
 
+    # True if the Arduino already has (or is about to have) this value, so that sending it again would be redundant.
+    # Otherwise, the command is recorded as pending and False is returned.
+    # field is the interface attribute the Arduino reports the value in.
+    def _is_redundant(self, command: str, value: int, field: str) -> bool:
+        now_s = time.monotonic()
+        pending = self._pending_commands.get(command)
+        reported_s = self._reported_at.get(field)
+        if pending is not None and now_s - pending[1] < PENDING_COMMAND_TIMEOUT_S:
+            expected_value = pending[0]
+        elif reported_s is not None and (pending is None or reported_s > pending[1]):
+            expected_value = getattr(self, field)
+        else:
+            expected_value = None  # Not reported since the command was sent: whether it arrived is unknown.
+        if value == expected_value:
+            self._commands_suppressed += 1
+            return True
+        self._pending_commands[command] = (value, now_s)
+        self._commands_sent += 1
+        return False
+
     # Speed: 0 <= speed <= 255
     def set_motor_speed(self, speed: int):
-        self.write(f"s{speed:03}")
+        if not self._is_redundant('s', speed, '_motor_speed'):
+            self.write(f"s{speed:03}")
 
     def get_motor_speed(self):
         return self._motor_speed
 
     # Direction: 0 neither. 1 = left. 2 = right.
     def set_motor_direction(self, motor_direction: int):
-        self.write(f"d{motor_direction}")
+        if not self._is_redundant('d', motor_direction, '_motor_direction'):
+            self.write(f"d{motor_direction}")
 
     def get_motor_direction(self):
         return self._motor_direction
@@ -105,6 +210,25 @@ class ArduinoInterface():
     def set_status_interval(self, interval: int):
         self.write(f"i{interval:04}")
 
+    # Compact: the Arduino reports its status as one checksummed line (z=...), instead of one line per value.
+    def set_compact_status(self, compact: bool):
+        self.write(f"f{1 if compact else 0}")
+
+    # Number of lines from the Arduino that could not be parsed.
+    def get_parse_errors(self) -> int:
+        return self._parse_errors
+
+    # Number of complete status reports from the Arduino that have been applied.
+    def get_reports_applied(self) -> int:
+        return self._reports_applied
+
+    # Counters and timings describing the link to the Arduino.
+    def get_stats(self) -> dict:
+        return dict(parse_errors=self._parse_errors,
+                    reports_applied=self._reports_applied,
+                    motor_commands_sent=self._commands_sent,
+                    motor_commands_suppressed=self._commands_suppressed)
+
     # Rudder position. Cannot be set. Determined by rudder angle sensor.
     def get_rudder_position(self):
         return self._rudder_position
@@ -133,6 +257,68 @@ def getInterface():
 
 ################################################################################
 # For testing and exemplification
+
+# A compact status line, byte for byte as reportCompactStatus (adrianAutoPilot.ino) prints it: the snprintf'd values,
+# '*', the XOR of the values' characters as printHex prints it (two dec2hexDigit chars), and println's '\r\n'.
+def sketch_compact_status(clutch, left_limit, right_limit, motor_speed, motor_direction, position,
+                          exception_direction) -> bytes:
+    report = b"%1d%04d%04d%03d%1d%04d%1d" % (clutch, left_limit, right_limit, motor_speed, motor_direction, position,
+                                             exception_direction)
+    checksum = 0
+    for c in report:
+        checksum ^= c
+    hex_digits = bytes(nibble + ord('0') if nibble <= 9 else nibble - 10 + ord('a')
+                       for nibble in (checksum >> 4, checksum & 0x0F))
+    return b"z=" + report + b"*" + hex_digits + b"\r\n"
+
+def test_compact_status():
+    from modules.anglemath import test_equals
+    arduino = ArduinoInterface()
+    # Split into lines as serial_monitor does, so the line keeps its '\r'.
+    apply_arduino_lines(arduino, sketch_compact_status(1, 100, 1023, 255, 2, 512, 1).split(b'\n'))
+    test_equals(0, arduino.get_parse_errors())
+    test_equals((1, 100, 1023, 255, 2, 512, 1),
+                (arduino.get_status(), arduino.get_port_limit(), arduino.get_stbd_limit(), arduino.get_motor_speed(),
+                 arduino.get_motor_direction(), arduino.get_rudder_position(), arduino.get_rudder_direction()))
+    # A checksum with a letter in it (0b).
+    test_equals(b"*0b\r\n", sketch_compact_status(0, 100, 1023, 0, 0, 28, 0)[-5:])
+    apply_arduino_lines(arduino, sketch_compact_status(0, 100, 1023, 0, 0, 28, 0).split(b'\n'))
+    test_equals((0, 28), (arduino.get_status(), arduino.get_rudder_position()))
+    test_equals(0, arduino.get_parse_errors())
+    # A damaged line, or one with anything after the checksum, is rejected.
+    line = sketch_compact_status(1, 100, 1023, 255, 2, 600, 1)
+    apply_arduino_lines(arduino, [line.replace(b'0600', b'0601')])
+    apply_arduino_lines(arduino, [line.replace(b'\r\n', b'0')])
+    test_equals(28, arduino.get_rudder_position())
+    test_equals(2, arduino.get_parse_errors())
+    test_equals(2, arduino.get_reports_applied())
+    # A verbose report counts once, when its last line (x=) arrives.
+    apply_arduino_lines(arduino, b"c=1\r\nl=100\r\nr=1023\r\ns=0\r\nd=0\r\np=30\r\n".split(b'\n'))
+    apply_arduino_lines(arduino, [b"x=0\r"])
+    test_equals(3, arduino.get_reports_applied())
+
+def test_motor_command_suppression():
+    from modules.anglemath import test_equals
+    arduino = ArduinoInterface()
+    written = []
+    arduino.write = written.append
+    # Neither a rejected status line nor a message says anything about the motor: both commands are sent.
+    apply_arduino_lines(arduino, [b"z=damaged\r", b"m=REBOOTED\r"])
+    arduino.set_motor_direction(MOTOR_LEFT)
+    time.sleep(PENDING_COMMAND_TIMEOUT_S + 0.1)
+    arduino.set_motor_direction(MOTOR_NEITHER)
+    test_equals(["d1", "d0"], written)
+    # While pending, repeating the command is suppressed.
+    arduino.set_motor_direction(MOTOR_NEITHER)
+    test_equals(["d1", "d0"], written)
+    # Once the Arduino has reported since the command was sent, its report is believed.
+    time.sleep(PENDING_COMMAND_TIMEOUT_S + 0.1)
+    apply_arduino_lines(arduino, [b"d=0\r"])
+    arduino.set_motor_direction(MOTOR_NEITHER)
+    test_equals(["d1", "d0"], written)
+    arduino.set_motor_direction(MOTOR_RIGHT)
+    test_equals(["d1", "d0", "d2"], written)
+
 def testBrain():
 
     arduino = getInterface()  # Create monitor and writer.
@@ -145,6 +331,8 @@ def testBrain():
     print("Stopped.")
 
 if __name__ == "__main__":
+    test_compact_status()
+    test_motor_command_suppression()
     testBrain()
     
 #Brain Received 'publishing 0'
@@ -1,81 +1,168 @@
 ## Adrian Vrouwenvelder
 ## March 21, 2023
 
-from modules.arduinoInterface import ArduinoInterface, from_arduino
+from modules.arduinoInterface import ArduinoInterface, apply_arduino_lines
+from modules.scheduler import TimingStats
+import select
+import threading
 import time
 import serial
 
+# Seconds the event-driven reader waits for data before checking whether it should still be running.
+READ_TIMEOUT_S = 0.05
+# Commands waiting to be written to the Arduino are kept at most one per command letter. Every command sets a value
+# (clutch, speed, direction, limit, interval), so while a command is waiting, a newer command with the same letter
+# replaces it, keeping its place in the queue. The queue therefore never holds more than one command per letter, but
+# commands with different letters may be written out of the order they were issued: e.g. s100, d1, s000 is written
+# as s000, d1.
+# Seconds a single write may block before the port is considered stalled.
+WRITE_TIMEOUT_S = 1
+
 class ArduinoSerialInterface(ArduinoInterface):
 
-    def __init__(self):
+    # The port is opened once, and shared by the monitor thread (reading) and the writer thread (writing).
+    # write() only queues the command, so callers (e.g. web requests) never wait for the port.
+    # event_driven: if True, the monitor wakes as soon as data arrives from the Arduino.
+    #               if False, it polls every get_check_interval() seconds.
+    def __init__(self, usb="/dev/ttyUSB0", event_driven=True):
         super().__init__()
-        self._usb = "/dev/ttyUSB0"
+        self._usb = usb
         self._baudrate = 115200
-        self._serial_out = serial.Serial(
+        self._event_driven = event_driven
+        self._apply_latency = TimingStats()  # Seconds from reading a batch of lines to having applied them.
+        self._last_arrival_s = None  # time.monotonic() at which the latest batch of lines was read
+        self._writer_thread = threading.Thread(target=self.serial_writer)
+        self._writer_thread.daemon = True
+        self._write_queue = {}  # command letter -> (time queued, command), in the order first queued
+        self._write_queue_changed = threading.Condition()
+        self._write_queue_wait = TimingStats()  # Seconds commands spent in the queue
+        self._write_duration = TimingStats()  # Seconds spent writing each command to the port
+        self._write_queue_high_water = 0
+        self._commands_queued = 0
+        self._commands_written = 0
+        self._commands_coalesced = 0
+        self._serial = serial.Serial(
                 port=self._usb,
                 timeout=1,
+                write_timeout=WRITE_TIMEOUT_S,
                 baudrate=self._baudrate)
         time.sleep(0.2)  # Wait for serial to open
-        if not self._serial_out.is_open:
+        if not self._serial.is_open:
             print('ERROR: __init__: Port is not open: ' + self._usb)
         else:
-            self._serial_out.reset_output_buffer()
-            print(f'INFO: __init__: {self._serial_out.port} Connected for sending commands at {str(self._serial_out.baudrate)}!')
+            self._serial.reset_input_buffer()
+            self._serial.reset_output_buffer()
+            print(f'INFO: __init__: {self._serial.port} Connected at {str(self._serial.baudrate)}!')
 
+    #override
+    def start(self):
+        super().start()
+        self._writer_thread.start()
 
     #override
     def serial_monitor(self) -> None:
-        with serial.Serial(
-                port=self._usb,
-                timeout=1,
-                baudrate=self._baudrate) as serial_in:
-            serial_in.flushInput()
-            time.sleep(0.2)  # Wait for serial to open
-            if not serial_in.is_open:
-                print('ERROR: serial_monitor: Could not open port ' + self._usb)
-                return
-            if not self.is_running():
-                print("WARNING: serial_monitor: Not running.")
-                return
-            print(f'INFO: serial_monitor: {serial_in.port} Connected for monitoring at {str(serial_in.baudrate)}!')
-            while (self.is_running()):
-                time.sleep(self.get_check_interval())
-                try:
-                    while serial_in.in_waiting > 0:
-                        message = serial_in.readline().decode('utf-8').strip()
-                        if message != '':
-                            from_arduino(interface=self, msg=message)
-                except ValueError:
-                    print(f"ERROR: serial_monitor: Value error!")
-                except serial.SerialException as e:
-                    print(f"ERROR: serial_monitor: Serial Exception! {str(e)}")
-                except KeyboardInterrupt as e:
-                    print(f"ERROR: serial_monitor: Keyboard Interrupt {str(e)}")
+        serial_in = self._serial
+        if not serial_in.is_open:
+            print('ERROR: serial_monitor: Port is not open: ' + self._usb)
+            return
+        if not self.is_running():
+            print("WARNING: serial_monitor: Not running.")
+            return
+        print(f'INFO: serial_monitor: Monitoring {serial_in.port}')
+        partial_line = b''
+        while (self.is_running()):
+            try:
+                if self._event_driven:
+                    readable, _, _ = select.select([serial_in], [], [], READ_TIMEOUT_S)
+                    if not readable:
+                        continue
+                else:
+                    time.sleep(self.get_check_interval())
+                waiting = serial_in.in_waiting
+                if waiting > 0:
+                    # Everything received since the last check, split into lines. The last piece is the start of
+                    # a line that is still arriving, so keep it for next time.
+                    data = serial_in.read(waiting)
+                    arrival_s = time.monotonic()
+                    lines = (partial_line + data).split(b'\n')
+                    partial_line = lines.pop()
+                    if len(lines) > 0:
+                        apply_arduino_lines(interface=self, lines=lines)
+                        self._last_arrival_s = arrival_s
+                        self._apply_latency.add(time.monotonic() - arrival_s)
+            except ValueError:
+                print(f"ERROR: serial_monitor: Value error!")
+            except serial.SerialException as e:
+                print(f"ERROR: serial_monitor: Serial Exception! {str(e)}")
+            except KeyboardInterrupt as e:
+                print(f"ERROR: serial_monitor: Keyboard Interrupt {str(e)}")
+
+    # Write queued commands to the port, one at a time, in the order they were queued.
+    def serial_writer(self) -> None:
+        serial_out = self._serial
+        if not serial_out.is_open:
+            print('ERROR: serial_writer: Port is not open: ' + self._usb)
+            return
+        while self.is_running():
+            with self._write_queue_changed:
+                if not self._write_queue_changed.wait_for(lambda: len(self._write_queue) > 0, READ_TIMEOUT_S):
+                    continue
+                queued_s, msg = self._write_queue.pop(next(iter(self._write_queue)))
+            start_s = time.monotonic()
+            self._write_queue_wait.add(start_s - queued_s)
+            try:
+                serial_out.write((msg + "\n").encode())
+                self._commands_written += 1
+            except ValueError:
+                print(f"ERROR: serial_writer: Value error! {msg}")
+            except serial.SerialException as e:
+                print(f"ERROR: serial_writer: Serial Exception! {str(e)}")
+            self._write_duration.add(time.monotonic() - start_s)
 
     #override
     def write(self, msg: str) -> None:
-        if not self._serial_out.is_open:
-            print('ERROR: write: Port is not open: ' + self._usb)
-            return
-        try:
-            self._serial_out.write((msg + "\n").encode())
-        except ValueError:
-            print(f"ERROR: write: Value error! {msg}")
-        except serial.SerialException as e:
-            print(f"ERROR: write: Serial Exception! {str(e)}")
-        except KeyboardInterrupt as e:
-            print(f"ERROR: write: Keyboard Interrupt {str(e)}")
+        command = msg[:1]
+        with self._write_queue_changed:
+            self._commands_queued += 1
+            if command in self._write_queue:
+                # Supersede the waiting command, keeping its place (and queue time) in the queue.
+                self._write_queue[command] = (self._write_queue[command][0], msg)
+                self._commands_coalesced += 1
+                return
+            self._write_queue[command] = (time.monotonic(), msg)
+            if len(self._write_queue) > self._write_queue_high_water:
+                self._write_queue_high_water = len(self._write_queue)
+            self._write_queue_changed.notify()
+
+    # Seconds since the latest line from the Arduino was read, or None if nothing has been read yet.
+    def get_status_age(self):
+        return None if self._last_arrival_s is None else time.monotonic() - self._last_arrival_s
+
+    #override
+    def get_stats(self) -> dict:
+        stats = super().get_stats()
+        stats['reader'] = 'event' if self._event_driven else 'polling'
+        stats['status_age_ms'] = None if self._last_arrival_s is None else 1000 * self.get_status_age()
+        stats['apply_latency_ms'] = self._apply_latency.summary_ms()
+        stats['write_queue_depth'] = len(self._write_queue)
+        stats['write_queue_high_water'] = self._write_queue_high_water
+        stats['commands_queued'] = self._commands_queued
+        stats['commands_written'] = self._commands_written
+        stats['commands_coalesced'] = self._commands_coalesced
+        stats['write_queue_wait_ms'] = self._write_queue_wait.summary_ms()
+        stats['write_duration_ms'] = self._write_duration.summary_ms()
+        return stats
 
 #override
-def getInterface():
-    return ArduinoSerialInterface()
+def getInterface(usb="/dev/ttyUSB0", event_driven=True):
+    return ArduinoSerialInterface(usb=usb, event_driven=event_driven)
 
 ################################################################################
 # For testing and exemplification
 def cmd_line():
 
     arduino = getInterface()  # Create monitor and writer.
-    arduino.start()  # Start monitor thread
+    arduino.start()  # Start monitor and writer threads
     print(f'Append commands to arduino to simulate Arduino sending data')
     print(f'From a command prompt, monitor arduino to see data we\'re sending to the Arduino.')
     while True:
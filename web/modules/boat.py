@@ -1,10 +1,10 @@
 # Author: Adrian Vrouwenvelder
-from island_time import time # Make things simulate faster
 import logging
 import sys
 from config import Config as BoatConfig
 from anglemath import calculate_angle_difference, normalize_angle
 from sensor import Sensor
+from clock import REAL_CLOCK, VirtualClock
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(filename)s %(message)s',
@@ -16,7 +16,9 @@ logger = logging.getLogger(__name__)
 
 
 class Boat:
-    def __init__(self, boat_config):
+    # clock (see clock.py) is the time the boat moves in. Simulations pass a VirtualClock, shared with their PID.
+    def __init__(self, boat_config, clock=REAL_CLOCK):
+        self.clock = clock
         self.max_boat_turn_rate_dps = float(boat_config.get_boat_turn_rate_dps()) # Angular velocity of boat with rudder hard over. TODO: Consider speed, point of sail
         self.rudder_speed_dps = float(boat_config.get_rudder_speed_dps()) # Speed at which actuator moves rudder rudder. Determine empirically.
         self.max_rudder_deflection_deg = float(boat_config.get_max_rudder_deflection_deg()) # Maximum rudder deflection. Determine empirically.
@@ -29,7 +31,7 @@ class Boat:
         # In a real world
         # The following are used only for simulating real conditions, to test with.
         # They would ordinarily come from the boat sensor unit
-        now_s = time.time()
+        now_s = self.clock.time()
         self.prev_heading_adjustment_time_s = now_s
         self.prev_rudder_adjustment_time_s = now_s
 
@@ -37,17 +39,17 @@ class Boat:
     # Rudder action does not happen immediately because the rudder needs time to move into position.
     def request_rudder_angle(self, commanded_rudder_deflection_deg):
         if commanded_rudder_deflection_deg > self.max_rudder_deflection_deg: 
-            logger.debug(f" NOTE: corrected {commanded_rudder_deflection_deg:6.0f} to {self.max_rudder_deflection_deg:4.0f}")
+            logger.debug(" NOTE: corrected %6.0f to %4.0f", commanded_rudder_deflection_deg, self.max_rudder_deflection_deg)
             commanded_rudder_deflection_deg = self.max_rudder_deflection_deg
         elif commanded_rudder_deflection_deg < -self.max_rudder_deflection_deg: 
-            logger.debug(f" NOTE: corrected {commanded_rudder_deflection_deg:6.0f} to {-self.max_rudder_deflection_deg:4.0f}")
+            logger.debug(" NOTE: corrected %6.0f to %4.0f", commanded_rudder_deflection_deg, -self.max_rudder_deflection_deg)
             commanded_rudder_deflection_deg = -self.max_rudder_deflection_deg
         self.commanded_rudder_deflection_deg = commanded_rudder_deflection_deg
          
     # In a real world, heading "adjustment" would be unnecessary - heading is a result of rudder adjustment, and is obtained from the sensor.
     # Also, rudder angle would be determined empirically from the sensor.
     def tick(self):
-        now_s = time.time()
+        now_s = self.clock.time()
         dt_s = now_s - self.prev_rudder_adjustment_time_s
         self.prev_rudder_adjustment_time_s = now_s
         rudder_deflection_diff_deg = -calculate_angle_difference(self.commanded_rudder_deflection_deg, self.current_rudder_deflection_deg)
@@ -67,27 +69,29 @@ class Boat:
         boat_turn_rate_dps = rudder_percent * self.max_boat_turn_rate_dps 
         # Update the heading sensor artificially - since this is just a simulator, it won't update itself.
         self.sensor.heading = normalize_angle(self.sensor.heading + boat_turn_rate_dps * dt_s)
-        logger.debug(f"TICK: t={time.time():4.1f}, commanded rudder = {self.commanded_rudder_deflection_deg:6.0f} current rudder={self.current_rudder_deflection_deg:4.0f}, heading={self.sensor.heading:4.0f}")
+        # Formatted only if it is going to be logged: this runs every simulation step.
+        logger.debug("TICK: t=%4.1f, commanded rudder = %6.0f current rudder=%4.0f, heading=%4.0f", now_s, self.commanded_rudder_deflection_deg, self.current_rudder_deflection_deg, self.sensor.heading)
 
 # For testing only
 # The following demonstrates rudder action's effect on boat heading
 if __name__ == "__main__":
     args = sys.argv[1:]
-    boat = Boat(BoatConfig("config.yaml" if len(args) == 0 else args[0]))
+    clock = VirtualClock()  # Make things simulate faster
+    boat = Boat(BoatConfig("config.yaml" if len(args) == 0 else args[0]), clock)
 
     boat.sensor.heading = 0
     logger.debug("***** Simulating course change right from 0 to 90 with rudder angle of 45")
     boat.request_rudder_angle(45)
     iterations = 0
-    now_s = time.time()
+    now_s = clock.time()
     # Allow boat to turn until heading is 90 or time is exceeded.
-    while boat.sensor.heading < 90 and (time.time() - now_s < 60):
+    while boat.sensor.heading < 90 and (clock.time() - now_s < 60):
         boat.tick()
-        time.sleep(1)
+        clock.sleep(1)
 
-    logger.debug(f"***** t={time.time()} - Simulating course change left to 80 with rudder angle of -5")
+    logger.debug(f"***** t={clock.time()} - Simulating course change left to 80 with rudder angle of -5")
     boat.request_rudder_angle(-5)
-    now_s = time.time()
-    while boat.sensor.heading > 80 and (time.time() - now_s < 60):
+    now_s = clock.time()
+    while boat.sensor.heading > 80 and (clock.time() - now_s < 60):
         boat.tick()
-        time.sleep(1)
+        clock.sleep(1)
@@ -2,8 +2,11 @@
 ## December 1, 2022
 ## March 2023
 
+from modules.config import Config
+from modules.control_loop import ControlLoop
 from modules.direction import normalize
 from modules.sensor import Sensor
+from modules.snapshot import BrainSnapshot
 from modules.status import DISABLED as STATUS_DISABLED, ENABLED as STATUS_ENABLED
 
 from modules.arduinoInterface import ArduinoInterface
@@ -11,15 +14,37 @@ from modules.arduinoSerialInterface import getInterface as getArduinoInterface
 
 # from modules.arduinoFileInterface import getInterface as getArduinoInterface
 
+import threading
 import time
 
+DEFAULT_CONFIG_FILE = "/mnt/mmcblk0p2/apps/adrianAutoPilot/configuration/config.yaml"
+
 
 class Brain():
 
-    def __init__(self):
+    def __init__(self, config_file=DEFAULT_CONFIG_FILE):
         self._course = 0
+        self._config = Config(config_file)
         self._sensor = Sensor()
         self._arduino_interface: ArduinoInterface = None
+        # A new snapshot (with the next version) is published every tick, and whenever the brain's state is changed.
+        self._snapshot: BrainSnapshot = None
+        self._state_changed = threading.Condition()
+        self._control_loop = ControlLoop(self)
+
+    # Start steering, and publishing snapshots every tick.
+    def start(self):
+        self.publish_snapshot()
+        self._control_loop.start()
+
+    def stop(self):
+        self._control_loop.stop()
+
+    def get_control_loop_stats(self) -> dict:
+        return self._control_loop.get_stats()
+
+    def get_sensor_stats(self) -> dict:
+        return self._sensor.get_imu_stats()
 
     def get_messages(self):
         return self._arduino_interface.get_messages();
@@ -30,8 +55,44 @@ class Brain():
     def get_arduino_interface(self) -> ArduinoInterface:
         return self._arduino_interface
 
+    def get_config(self) -> Config:
+        return self._config
+
+    # Read the current state once and publish it as the snapshot all readers will share.
+    def publish_snapshot(self) -> BrainSnapshot:
+        interface = self._arduino_interface
+        sample = self._sensor.get_sample()  # So heading and heel come from the same IMU sample
+        with self._state_changed:
+            self._snapshot = BrainSnapshot(
+                version=0 if self._snapshot is None else self._snapshot.version + 1,
+                timestamp=time.monotonic(),
+                heading=sample.heading,
+                heel=sample.heel,
+                course=self._course,
+                clutch_status=interface.get_status(),
+                starboard_limit=interface.get_stbd_limit(),
+                port_limit=interface.get_port_limit(),
+                motor_speed=interface.get_motor_speed(),
+                motor_direction=interface.get_motor_direction(),
+                rudder_position=interface.get_rudder_position(),
+                rudder_direction=interface.get_rudder_direction(),
+                messages=interface.get_messages())
+            self._state_changed.notify_all()
+            return self._snapshot
+
+    def get_snapshot(self) -> BrainSnapshot:
+        return self._snapshot
+
+    # Block until a snapshot with a version other than last_version is published, or timeout (seconds) has elapsed.
+    # Returns the current snapshot's version.
+    def wait_for_state_change(self, last_version: int, timeout: float) -> int:
+        with self._state_changed:
+            self._state_changed.wait_for(lambda: self._snapshot.version != last_version, timeout)
+            return self._snapshot.version
+
     def set_course(self, course: int) -> int:
         self._course = normalize(course)
+        self.publish_snapshot()
 
     def get_course(self) -> int:
         return self._course
@@ -44,22 +105,25 @@ class Brain():
 
     def set_status(self, status):
         self._arduino_interface.set_status(1 if status == STATUS_ENABLED else 0)
+        self.publish_snapshot()
 
     def get_status(self) -> str:
         return STATUS_ENABLED if self._arduino_interface.get_status() == 1 else STATUS_DISABLED
 
     def adjust_course(self, delta: int) -> int:
         self._course = normalize(self._course + delta)
+        self.publish_snapshot()
 
 _brain: Brain
 
 
-def getInstance():
+def getInstance(config_file=DEFAULT_CONFIG_FILE):
     global _brain
-    _brain = Brain()
+    _brain = Brain(config_file)
     arduino_interface = getArduinoInterface()
     _brain.set_arduino_interface(arduino_interface)
     arduino_interface.start()  # Create monitor and writer.
+    _brain.start()  # Start the control loop
     return _brain
 
 # For exemplification and testing from the command line
@@ -0,0 +1,39 @@
+## Adrian Vrouwenvelder
+## April 2023
+
+import time as real_time
+
+
+# Clocks, for code that both runs for real and in simulation (Boat, PID, ControlLoop, DeadlineScheduler). Each takes
+# one, and asks it for the time and to sleep, rather than using the time module directly, so that a simulation can
+# hand it a clock of its own. Both have the same two methods:
+#    time()        seconds, only ever increasing
+#    sleep(secs)   wait secs seconds
+
+
+# Real time, on the monotonic clock (which, unlike time.time(), does not jump when the system clock is set).
+class MonotonicClock:
+
+    def time(self) -> float:
+        return real_time.monotonic()
+
+    def sleep(self, secs: float):
+        real_time.sleep(secs)
+
+
+# Simulated time. Stands still until something sleeps, and then moves on by exactly the time slept, at once.
+# A simulation stepped by sleeping a fixed interval between steps runs as fast as the CPU allows, and gives the same
+# results every time. Each simulation has its own, so simulations can run side by side in threads or processes.
+class VirtualClock:
+
+    def __init__(self, start_s: float = 0.0):
+        self._now_s = start_s
+
+    def time(self) -> float:
+        return self._now_s
+
+    def sleep(self, secs: float):
+        self._now_s = self._now_s + secs
+
+
+REAL_CLOCK = MonotonicClock()  # Shared: it has no state
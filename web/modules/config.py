@@ -8,6 +8,8 @@ class Config:
         self.filename = filename
         self.gains = None
         self.boat_characteristics = None
+        self.control_loop = None
+        self.web = None
 
     def load_if_necessary(self):
         if self.gains == None:
@@ -15,6 +17,8 @@ class Config:
                 data = yaml.safe_load(stream)
                 self.boat_characteristics = data["boat_characteristics"]
                 self.gains = data["gains"]
+                self.control_loop = data["control_loop"]
+                self.web = data["web"]
 
     def get_max_rudder_deflection_deg(self):
         self.load_if_necessary()
@@ -32,6 +36,38 @@ class Config:
         self.load_if_necessary()
         return float(self.boat_characteristics["boat_turn_rate"])
 
+    def get_control_motor_speed(self):
+        self.load_if_necessary()
+        return int(self.control_loop["motor_speed"])
+
+    def get_rudder_deadband(self):
+        self.load_if_necessary()
+        return int(self.control_loop["rudder_deadband"])
+
+    def get_rudder_slowdown_range(self):
+        self.load_if_necessary()
+        return int(self.control_loop["slowdown_range"])
+
+    def get_min_motor_speed(self):
+        self.load_if_necessary()
+        return int(self.control_loop["min_motor_speed"])
+
+    def get_status_reports_per_interval(self):
+        self.load_if_necessary()
+        return int(self.control_loop["status_reports_per_interval"])
+
+    def get_compact_status(self):
+        self.load_if_necessary()
+        return bool(self.control_loop["compact_status"])
+
+    def get_control_stats_window(self):
+        self.load_if_necessary()
+        return int(self.control_loop["stats_window"])
+
+    def get_stream_interval_ms(self):
+        self.load_if_necessary()
+        return float(self.web["stream_interval"])
+
     def get_gain(self, gain, sea_state = "default"):
         self.load_if_necessary()
         if gain not in ['P','I','D']: 
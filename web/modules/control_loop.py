@@ -0,0 +1,118 @@
+## Adrian Vrouwenvelder
+## March 2023
+
+import threading
+
+from modules.arduinoInterface import MOTOR_NEITHER, MOTOR_LEFT, MOTOR_RIGHT
+from modules.clock import REAL_CLOCK
+from modules.pid_controller import PID
+from modules.scheduler import DeadlineScheduler
+
+
+# Closed-loop steering. Every sampling_interval (see config.yaml), while the clutch is engaged, the PID is run
+# against the sensor heading and the rudder is driven towards the deflection the PID asks for.
+# Each iteration ends by publishing the brain's snapshot, so readers see the state the loop acted on.
+# Iterations are paced by a DeadlineScheduler, whose jitter, latency and overrun statistics show whether the
+# loop actually holds its period. The loop runs on clock (see clock.py): real time, unless given another.
+class ControlLoop:
+
+    def __init__(self, brain, clock=REAL_CLOCK):
+        config = brain.get_config()
+        self._brain = brain
+        self._sampling_interval_ms = config.get_sampling_interval_ms()
+        self._max_rudder_deflection_deg = config.get_max_rudder_deflection_deg()
+        self._rudder_speed_dps = config.get_rudder_speed_dps()  # At full motor speed
+        self._motor_speed = config.get_control_motor_speed()
+        self._min_motor_speed = config.get_min_motor_speed()
+        self._rudder_deadband = config.get_rudder_deadband()
+        self._slowdown_range = config.get_rudder_slowdown_range()
+        self._status_interval_ms = max(1, int(self._sampling_interval_ms / config.get_status_reports_per_interval()))
+        self._compact_status = config.get_compact_status()
+        self._gains = (config.get_P_gain(), config.get_I_gain(), config.get_D_gain())
+        self._pid: PID = None  # Created when the clutch engages, so that every engagement starts with no integral.
+        self._commanded_rudder_deg = 0.0
+        self._motor_direction = MOTOR_NEITHER  # As last commanded
+        self._clock = clock
+        self._scheduler = DeadlineScheduler(self._sampling_interval_ms / 1000, config.get_control_stats_window(), clock)
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._running = False
+
+    def start(self):
+        self._running = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+
+    def is_running(self):
+        return self._running
+
+    def get_commanded_rudder_deg(self) -> float:
+        return self._commanded_rudder_deg
+
+    def get_stats(self) -> dict:
+        return self._scheduler.get_stats()
+
+    def run(self):
+        interface = self._brain.get_arduino_interface()
+        interface.set_compact_status(self._compact_status)
+        # Rudder position reports are needed several times as often as the loop runs: at one per iteration, the
+        # position acted on could be a whole period old.
+        interface.set_status_interval(self._status_interval_ms)
+        while self.is_running():
+            self._scheduler.wait()
+            try:
+                self.tick()
+            except Exception as e:  # One bad iteration must not stop the autopilot.
+                print(f"ERROR: control_loop: {type(e).__name__} {str(e)}")
+            self._scheduler.done()
+
+    def tick(self):
+        brain = self._brain
+        interface = brain.get_arduino_interface()
+        if interface.get_status() == 1:  # Clutch engaged
+            if self._pid is None:
+                self._pid = PID(*self._gains, self._sampling_interval_ms, self._clock)
+            self._pid.set_target_value(brain.get_course())
+            # Output of compute_output is in same direction as error, so flip the sign to turn it into a correction.
+            self._commanded_rudder_deg = -self._pid.compute_output(process_value=brain.get_heading())
+            self.move_rudder_towards(self._commanded_rudder_deg)
+        elif self._pid is not None:  # Clutch was just disengaged
+            self._pid = None
+            self._commanded_rudder_deg = 0.0
+            self._motor_direction = MOTOR_NEITHER
+            interface.set_motor_direction(MOTOR_NEITHER)
+        brain.publish_snapshot()
+
+    # Positive deflection turns to starboard (right), negative to port (left).
+    # The rudder sensor reads port_limit at full port deflection and stbd_limit at full starboard deflection.
+    # The motor slows as the rudder nears the target, and is stopped, rather than reversed, if the rudder has gone
+    # past it: the next iteration, with a newer position, sets off back if the rudder is still outside the deadband.
+    # Between a position report and the motor stopping in response to it (up to an iteration plus a status interval
+    # later), the rudder moves on, even at min_motor_speed. The deadband is kept at least twice that wide, so that
+    # the rudder cannot step over it.
+    def move_rudder_towards(self, rudder_deg: float):
+        interface = self._brain.get_arduino_interface()
+        rudder_deg = max(-self._max_rudder_deflection_deg, min(self._max_rudder_deflection_deg, rudder_deg))
+        port_limit = interface.get_port_limit()
+        stbd_limit = interface.get_stbd_limit()
+        target_position = (port_limit + stbd_limit) / 2 + \
+            (rudder_deg / self._max_rudder_deflection_deg) * (stbd_limit - port_limit) / 2
+        position_error = target_position - interface.get_rudder_position()
+        units_per_deg = abs(stbd_limit - port_limit) / 2 / self._max_rudder_deflection_deg
+        min_speed_travel = self._rudder_speed_dps * units_per_deg * (self._min_motor_speed / 255) * \
+            (self._sampling_interval_ms + self._status_interval_ms) / 1000
+        deadband = max(self._rudder_deadband, min_speed_travel / 2)
+        direction = MOTOR_NEITHER
+        if abs(position_error) > deadband:
+            # Sensor readings may increase towards either limit.
+            towards_stbd = (position_error > 0) == (stbd_limit > port_limit)
+            direction = MOTOR_RIGHT if towards_stbd else MOTOR_LEFT
+            if self._motor_direction not in (MOTOR_NEITHER, direction):  # Overshot
+                direction = MOTOR_NEITHER
+            else:
+                speed = int(self._motor_speed * abs(position_error) / self._slowdown_range)
+                interface.set_motor_speed(max(self._min_motor_speed, min(self._motor_speed, speed)))
+        interface.set_motor_direction(direction)
+        self._motor_direction = direction
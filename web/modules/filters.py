@@ -0,0 +1,162 @@
+## Adrian Vrouwenvelder
+## April 2023
+
+from bisect import bisect_left, insort
+from math import cos, pi, sin
+
+# Smoothing filters for sensor channels. Each filters a fixed number of channels (3 for a vector, 1 for a scalar)
+# together: update() takes a sequence of that many values and returns the filtered tuple. All storage is allocated
+# up front, and each update costs the same however long the filter has been running.
+# The first value passed to update() primes the filter, so there is no ramp up from zero.
+#
+# Pick a filter per sensor channel in the mpu9250 section of config.yaml:
+#   filter:
+#     type: ema        # ema, boxcar, median or lowpass
+#     window_size: 5   # ema, boxcar and median
+#     cutoff: 2.0      # lowpass only: cutoff frequency in Hz
+#     q: 0.7071        # lowpass only, optional: 0.7071 (Butterworth) if not given
+
+
+# Exponential moving average: each value moves the output 1/window_size of the way towards it.
+# No memory beyond the output, and the least CPU, but a spike still pulls the output 1/window_size of the way.
+class EmaFilter:
+
+    def __init__(self, channels: int, window_size: int):
+        self._window_size = window_size
+        self._output = None
+
+    def update(self, values) -> tuple:
+        if self._output is None:
+            self._output = tuple(values)
+        else:
+            n = self._window_size
+            self._output = tuple((value + average * (n - 1)) / n for value, average in zip(values, self._output))
+        return self._output
+
+
+# Mean of the last window_size values. Unlike the EMA, a value stops counting altogether after window_size updates.
+class BoxcarFilter:
+
+    def __init__(self, channels: int, window_size: int):
+        self._channels = channels
+        self._window_size = window_size
+        self._ring = [0.0] * (channels * window_size)  # window_size rows of channels values
+        self._sums = [0.0] * channels
+        self._count = 0  # Values held so far, up to window_size
+        self._next = 0  # Row to write next
+        self._output = None
+
+    def update(self, values) -> tuple:
+        ring, sums, channels = self._ring, self._sums, self._channels
+        base = self._next * channels
+        full = self._count == self._window_size
+        for c in range(channels):
+            if full:
+                sums[c] -= ring[base + c]
+            ring[base + c] = values[c]
+            sums[c] += values[c]
+        if not full:
+            self._count += 1
+        self._next += 1
+        if self._next == self._window_size:
+            self._next = 0
+            # Recompute the sums once a window, so that rounding errors from adding and subtracting can't build up.
+            if full:
+                for c in range(channels):
+                    sums[c] = sum(ring[c::channels])
+        self._output = tuple(total / self._count for total in sums)
+        return self._output
+
+
+# Median of the last window_size values, per channel. Rejects spikes (up to half the window) outright, where the
+# averaging filters smear them out. Each channel's window is also kept sorted, so an update is a binary search plus
+# a short list move, which is negligible for the small windows (3 to 9) that spike rejection needs.
+class MedianFilter:
+
+    def __init__(self, channels: int, window_size: int):
+        self._channels = channels
+        self._window_size = window_size
+        self._ring = [0.0] * (channels * window_size)
+        self._sorted = [[] for _ in range(channels)]
+        self._count = 0
+        self._next = 0
+        self._output = None
+
+    def update(self, values) -> tuple:
+        ring, channels = self._ring, self._channels
+        base = self._next * channels
+        full = self._count == self._window_size
+        for c in range(channels):
+            window = self._sorted[c]
+            if full:
+                del window[bisect_left(window, ring[base + c])]
+            ring[base + c] = values[c]
+            insort(window, values[c])
+        if not full:
+            self._count += 1
+        self._next = (self._next + 1) % self._window_size
+        middle = self._count // 2
+        if self._count % 2 == 1:
+            self._output = tuple(window[middle] for window in self._sorted)
+        else:
+            self._output = tuple((window[middle - 1] + window[middle]) / 2 for window in self._sorted)
+        return self._output
+
+
+# Second order low-pass (biquad, from the RBJ audio EQ cookbook, in transposed direct form II).
+# Passes motion below cutoff_hz, and cuts noise above it at 12dB per octave, with less lag for the same
+# smoothing than an average. sample_rate_hz is the rate update() is called at.
+class BiquadLowPassFilter:
+
+    def __init__(self, channels: int, cutoff_hz: float, sample_rate_hz: float, q: float = 0.7071):
+        if not 0 < cutoff_hz < sample_rate_hz / 2:
+            raise Exception(f"Low-pass cutoff {cutoff_hz} Hz must be between 0 and half the sample rate ({sample_rate_hz} Hz)")
+        w0 = 2 * pi * cutoff_hz / sample_rate_hz
+        alpha = sin(w0) / (2 * q)
+        a0 = 1 + alpha
+        self._b0 = (1 - cos(w0)) / 2 / a0
+        self._b1 = (1 - cos(w0)) / a0
+        self._b2 = self._b0
+        self._a1 = -2 * cos(w0) / a0
+        self._a2 = (1 - alpha) / a0
+        self._channels = channels
+        self._z1 = [0.0] * channels
+        self._z2 = [0.0] * channels
+        self._output = None
+
+    def update(self, values) -> tuple:
+        b0, b1, b2, a1, a2 = self._b0, self._b1, self._b2, self._a1, self._a2
+        z1, z2 = self._z1, self._z2
+        if self._output is None:
+            # Start as if the first value had always been the input, so the output starts there rather than at 0.
+            for c in range(self._channels):
+                z1[c] = values[c] * (1 - b0)
+                z2[c] = values[c] * (b2 - a2)
+        output = [0.0] * self._channels
+        for c in range(self._channels):
+            x = values[c]
+            y = b0 * x + z1[c]
+            z1[c] = b1 * x - a1 * y + z2[c]
+            z2[c] = b2 * x - a2 * y
+            output[c] = y
+        self._output = tuple(output)
+        return self._output
+
+
+# Build the filter for a sensor channel from its section of config.yaml (for example mpu9250: gyro:).
+# Sections without a filter keep the original behaviour: an EMA over moving_average_window_size.
+# sample_rate_hz is the rate the channel's values arrive at.
+def make_filter(channel_config: dict, channels: int, sample_rate_hz: float):
+    if 'filter' not in channel_config:
+        return EmaFilter(channels, channel_config['moving_average_window_size'])
+    config = channel_config['filter']
+    filter_type = config['type']
+    if filter_type == 'ema':
+        return EmaFilter(channels, config['window_size'])
+    if filter_type == 'boxcar':
+        return BoxcarFilter(channels, config['window_size'])
+    if filter_type == 'median':
+        return MedianFilter(channels, config['window_size'])
+    if filter_type == 'lowpass':
+        return BiquadLowPassFilter(channels, config['cutoff'], sample_rate_hz, config.get('q', 0.7071))
+    raise Exception(f"Unknown filter type '{filter_type}'. Use ema, boxcar, median or lowpass")
@@ -0,0 +1,117 @@
+## Adrian Vrouwenvelder
+## April 2023
+
+from math import atan2, sqrt
+
+try:
+    from modules.anglemath import calculate_angle_difference, normalize_angle
+except ImportError:
+    from anglemath import calculate_angle_difference, normalize_angle
+
+RAD_TO_DEG = 57.29577951308232
+
+
+# The AK8963 sits in the MPU9250 package with its axes swapped: mag X is along accel/gyro Y, mag Y along X,
+# and mag Z is opposite to Z. Returns the mag vector in the accel/gyro frame.
+def mag_to_accel_frame(mag):
+    return (mag[1], mag[0], -mag[2])
+
+
+# Heading (degrees) of the horizontal component of the magnetic field, whatever the tilt.
+# up is the accel/gyro frame's up (the accelerometer's reading, any length), mag is in the accel/gyro frame.
+# The horizontal plane is spanned by h_y (the sensor's Y axis, leveled) and h_x = h_y x up. When level these are
+# just the sensor's Y and X axes, and this reduces to compass_deg_from_mag in imuInterface.
+# None if there is no heading to be had: up is zero, or the sensor's Y axis points straight up or down.
+def tilt_compensated_heading_deg(up, mag):
+    ux, uy, uz = up
+    norm = sqrt(ux * ux + uy * uy + uz * uz)
+    if norm == 0:
+        return None
+    ux, uy, uz = ux / norm, uy / norm, uz / norm
+    # h_y = Y - (Y . up) up, normalized
+    hyx, hyy, hyz = -uy * ux, 1 - uy * uy, -uy * uz
+    norm = sqrt(hyx * hyx + hyy * hyy + hyz * hyz)
+    if norm == 0:
+        return None
+    hyx, hyy, hyz = hyx / norm, hyy / norm, hyz / norm
+    # h_x = h_y x up
+    hxx, hxy, hxz = hyy * uz - hyz * uy, hyz * ux - hyx * uz, hyx * uy - hyy * ux
+    mx, my, mz = mag
+    return normalize_angle(atan2(mx * hyx + my * hyy + mz * hyz, mx * hxx + my * hxy + mz * hxz) * RAD_TO_DEG + 90)
+
+
+# Heel (degrees, positive to starboard) from the accelerometer alone. Same as heel_deg_from_accel in imuInterface.
+def accel_heel_deg(accel):
+    return atan2(accel[0], accel[2]) * RAD_TO_DEG
+
+
+# Complementary filter: integrates the gyro for heading and heel at the full IMU sample rate, and pulls the result
+# towards the magnetometer heading and the accelerometer heel with the configured time constants.
+# The gyro follows turns and rolls with no lag; the mag and accel, which are noisy and disturbed by the boat's
+# motion but do not drift, correct the gyro's drift over time_constant seconds.
+# Each update is a handful of multiplies, so it is cheap enough to run on every sample on the Pi.
+class ComplementaryFilter:
+
+    def __init__(self, heading_time_constant_s: float, heel_time_constant_s: float):
+        self._heading_tc_s = heading_time_constant_s
+        self._heel_tc_s = heel_time_constant_s
+        self._heading_deg = None  # None until the first mag reading
+        self._heel_deg = None  # None until the first accel reading
+        self._yaw_rate_dps = 0.0
+        self._heel_rate_dps = 0.0
+        self._up = (0.0, 0.0, 1.0)
+        self._last_sample_s = None
+        self._last_mag_s = None
+
+    # Accel (Gs) and gyro (dps) sample, both calibrated, in the accel/gyro frame, taken at sample_time_s (monotonic).
+    def update_accel_gyro(self, sample_time_s: float, accel, gyro):
+        ax, ay, az = accel
+        norm = sqrt(ax * ax + ay * ay + az * az)
+        if norm == 0:
+            return
+        self._up = accel
+        gx, gy, gz = gyro
+        # Turning about the up axis. Positive (clockwise seen from above) increases the heading.
+        self._yaw_rate_dps = -(gx * ax + gy * ay + gz * az) / norm
+        # Rolling about the Y axis. See accel_heel_deg.
+        self._heel_rate_dps = -gy
+        heel_deg = accel_heel_deg(accel)
+        if self._last_sample_s is None or self._heel_deg is None:
+            self._heel_deg = heel_deg
+        else:
+            dt_s = sample_time_s - self._last_sample_s
+            predicted_deg = self._heel_deg + self._heel_rate_dps * dt_s
+            self._heel_deg = predicted_deg + (heel_deg - predicted_deg) * dt_s / (self._heel_tc_s + dt_s)
+            if self._heading_deg is not None:
+                self._heading_deg = normalize_angle(self._heading_deg + self._yaw_rate_dps * dt_s)
+        self._last_sample_s = sample_time_s
+
+    # New mag reading (microteslas, calibrated) in the magnetometer's own frame, taken at sample_time_s.
+    # Ignored until there has been an accel reading to tilt compensate it with.
+    def update_mag(self, sample_time_s: float, mag):
+        if self._last_sample_s is None:
+            return
+        heading_deg = tilt_compensated_heading_deg(self._up, mag_to_accel_frame(mag))
+        if heading_deg is None:
+            return
+        if self._heading_deg is None:
+            self._heading_deg = heading_deg
+        else:
+            dt_s = sample_time_s - self._last_mag_s
+            correction = calculate_angle_difference(self._heading_deg, heading_deg)
+            self._heading_deg = normalize_angle(self._heading_deg + correction * dt_s / (self._heading_tc_s + dt_s))
+        self._last_mag_s = sample_time_s
+
+    def get_heading_deg(self) -> float:
+        return self._heading_deg
+
+    def get_heel_deg(self) -> float:
+        return self._heel_deg
+
+    # Degrees per second, positive turning to starboard.
+    def get_yaw_rate_dps(self) -> float:
+        return self._yaw_rate_dps
+
+    # Degrees per second, positive heeling further to starboard.
+    def get_heel_rate_dps(self) -> float:
+        return self._heel_rate_dps
@@ -0,0 +1,159 @@
+## Adrian Vrouwenvelder
+## April 2023
+
+from math import sqrt
+import random
+
+
+# Learns the gyro's bias (its reading when not turning), and how that bias changes with the chip's temperature,
+# from the readings taken whenever the sensor is still, so that the fixed bias in config.yaml does not have to be
+# remeasured, and the fused heading does not drift as the chip warms or cools over a long passage.
+#
+# Stillness: the gyro and accel readings' spread (an exponentially weighted standard deviation over
+# detect_time_constant) have both been below their thresholds, and the gyro readings' mean (over the same time) has
+# been within still_max_rate of the current bias on every axis, for still_time seconds. A steady turn has as little
+# spread as a still sensor; only its rate tells it apart.
+# Bias against temperature: a straight line, bias = intercept + slope * (temp - mean temp), fitted per axis by
+# exponentially weighted least squares over still readings, forgetting them over learn_time_constant seconds of
+# stillness. The slope is only fitted once the still readings span min_temp_range; until then it is held at 0.
+# The configured bias is the starting point, counted as prior_time seconds of still readings.
+# An update costs a few dozen multiplies, whether still or not.
+class GyroBiasEstimator:
+
+    def __init__(self, initial_bias, still_gyro_std, still_accel_std, still_max_rate, still_time_s,
+                 detect_time_constant_s, learn_time_constant_s, min_temp_range, prior_time_s):
+        self._still_gyro_var = still_gyro_std ** 2
+        self._still_accel_var = still_accel_std ** 2
+        self._still_max_rate = still_max_rate
+        self._still_time_s = still_time_s
+        self._detect_tc_s = detect_time_constant_s
+        self._learn_tc_s = learn_time_constant_s
+        self._min_temp_var = (min_temp_range / 2) ** 2  # Variance of temperatures spread evenly over the range, roughly
+        self._bias = tuple(initial_bias)
+        # Stillness detection
+        self._gyro_mean = None
+        self._gyro_var = 0.0
+        self._accel_mean = 0.0  # Magnitude, Gs
+        self._accel_var = 0.0
+        self._last_sample_s = None
+        self._still_since_s = None
+        # Weighted sums for the fit: weight, temp, temp^2, and per axis gyro and gyro * temp. Temperatures are taken
+        # relative to the first one seen, to keep the sums well conditioned.
+        self._temp_origin = None
+        self._w = prior_time_s
+        self._t = 0.0
+        self._tt = 0.0
+        self._g = [prior_time_s * b for b in initial_bias]
+        self._gt = [0.0, 0.0, 0.0]
+        self._slope = (0.0, 0.0, 0.0)
+        self._still_samples = 0
+
+    # Uncorrected gyro (dps), accel (Gs) and temp (Celsius), taken at sample_time_s. Returns the bias to subtract.
+    def update(self, sample_time_s, gyro, accel, temp):
+        gx, gy, gz = gyro
+        accel_magnitude = sqrt(accel[0] ** 2 + accel[1] ** 2 + accel[2] ** 2)
+        if self._last_sample_s is None:
+            self._gyro_mean = [gx, gy, gz]
+            self._accel_mean = accel_magnitude
+            self._temp_origin = temp
+            self._last_sample_s = sample_time_s
+            return self._get_bias(temp)
+        dt_s = sample_time_s - self._last_sample_s
+        self._last_sample_s = sample_time_s
+        if dt_s <= 0:
+            return self._get_bias(temp)
+
+        # Exponentially weighted mean and variance of the readings, for stillness detection
+        k = dt_s / (self._detect_tc_s + dt_s)
+        mean = self._gyro_mean
+        dx, dy, dz = gx - mean[0], gy - mean[1], gz - mean[2]
+        mean[0] += k * dx
+        mean[1] += k * dy
+        mean[2] += k * dz
+        self._gyro_var += k * ((1 - k) * (dx * dx + dy * dy + dz * dz) - self._gyro_var)
+        da = accel_magnitude - self._accel_mean
+        self._accel_mean += k * da
+        self._accel_var += k * ((1 - k) * da * da - self._accel_var)
+
+        bias = self._get_bias(temp)
+        if self._gyro_var > self._still_gyro_var or self._accel_var > self._still_accel_var or \
+                max(abs(mean[0] - bias[0]), abs(mean[1] - bias[1]), abs(mean[2] - bias[2])) > self._still_max_rate:
+            self._still_since_s = None
+            return bias
+        if self._still_since_s is None:
+            self._still_since_s = sample_time_s
+        if sample_time_s - self._still_since_s < self._still_time_s:
+            return bias
+
+        # Still: learn from this reading, weighting it by the time it covers, and forgetting older ones.
+        self._still_samples += 1
+        decay = self._learn_tc_s / (self._learn_tc_s + dt_s)
+        t = temp - self._temp_origin
+        self._w = self._w * decay + dt_s
+        self._t = self._t * decay + dt_s * t
+        self._tt = self._tt * decay + dt_s * t * t
+        g, gt = self._g, self._gt
+        for axis, value in enumerate(gyro):
+            g[axis] = g[axis] * decay + dt_s * value
+            gt[axis] = gt[axis] * decay + dt_s * value * t
+        self._fit()
+        return self._get_bias(temp)
+
+    def _fit(self):
+        w = self._w
+        mean_t = self._t / w
+        var_t = self._tt / w - mean_t * mean_t
+        means = [g / w for g in self._g]
+        if var_t >= self._min_temp_var:
+            self._slope = tuple((gt / w - mean_t * mean_g) / var_t for gt, mean_g in zip(self._gt, means))
+        self._bias = tuple(mean_g - slope * mean_t for mean_g, slope in zip(means, self._slope))
+
+    # Bias at temp: intercept (at the temperature origin) plus slope * temperature offset.
+    def _get_bias(self, temp):
+        if self._temp_origin is None:
+            return self._bias
+        t = temp - self._temp_origin
+        b, s = self._bias, self._slope
+        return (b[0] + s[0] * t, b[1] + s[1] * t, b[2] + s[2] * t)
+
+    def is_still(self) -> bool:
+        return self._still_since_s is not None and self._last_sample_s - self._still_since_s >= self._still_time_s
+
+    def get_stats(self) -> dict:
+        return dict(still=self.is_still(),
+                    still_samples=self._still_samples,
+                    intercept_dps=list(self._bias),
+                    temp_origin=self._temp_origin,
+                    slope_dps_per_degree=list(self._slope))
+
+
+################################################################################
+# For testing
+def test_close(expected, actual, tolerance):
+    if any(abs(e - a) > tolerance for e, a in zip(expected, actual)):
+        raise Exception(f"expected {expected} but got {actual}")
+
+# Ten minutes of 100 Hz readings, level, at a constant temperature: the true bias plus noise, plus a turn about z.
+def simulate(estimator, true_bias, turn_rate_dps=0.0, duration_s=600.0, seed=1):
+    rng = random.Random(seed)
+    bias = estimator.update(0.0, true_bias, (0.0, 0.0, 1.0), 25.0)
+    for n in range(1, int(duration_s * 100)):
+        gyro = (true_bias[0] + rng.gauss(0, 0.05), true_bias[1] + rng.gauss(0, 0.05),
+                true_bias[2] + turn_rate_dps + rng.gauss(0, 0.05))
+        bias = estimator.update(n / 100, gyro, (0.0, 0.0, 1.0 + rng.gauss(0, 0.001)), 25.0)
+    return bias
+
+def make_estimator(initial_bias):
+    return GyroBiasEstimator(initial_bias, still_gyro_std=0.3, still_accel_std=0.01, still_max_rate=1.0,
+                             still_time_s=3.0, detect_time_constant_s=1.0, learn_time_constant_s=600.0,
+                             min_temp_range=3.0, prior_time_s=30.0)
+
+if __name__ == "__main__":
+    from modules.anglemath import test_equals
+    # Still: the bias is learned, from a configured one that is 0.5 dps out.
+    estimator = make_estimator((-2.0, 0.5, 0.5))
+    test_close((-2.5, 1.0, 0.0), simulate(estimator, (-2.5, 1.0, 0.0)), 0.05)
+    # Steady 3 dps turn, with the configured bias right: not still, so the bias is left alone.
+    estimator = make_estimator((-2.5, 1.0, 0.0))
+    test_close((-2.5, 1.0, 0.0), simulate(estimator, (-2.5, 1.0, 0.0), turn_rate_dps=3.0), 0.001)
+    test_equals(0, estimator.get_stats()['still_samples'])
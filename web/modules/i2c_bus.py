@@ -0,0 +1,33 @@
+## Adrian Vrouwenvelder
+## April 2023
+
+
+# The I2C bus the IMU driver talks through: the Pi's real bus, via smbus2.
+# The driver only uses the methods below, so anything else that has them (such as the register emulator in
+# testing/mpu9250Emulator.py) can be passed to it instead, to run the driver without the hardware.
+class SMBusBackend:
+
+    def __init__(self, bus_number=1):
+        import smbus2  # Only needed on the real hardware
+        self._smbus2 = smbus2
+        self._bus = smbus2.SMBus(bus_number)
+
+    def read_byte_data(self, address, register) -> int:
+        return self._bus.read_byte_data(address, register)
+
+    def write_byte_data(self, address, register, value):
+        self._bus.write_byte_data(address, register, value)
+
+    # At most 32 bytes (the SMBus block limit).
+    def read_i2c_block_data(self, address, register, length) -> list:
+        return self._bus.read_i2c_block_data(address, register, length)
+
+    # Any number of bytes from register on, in one transaction. Raises OSError if the adapter cannot do it.
+    def read_burst(self, address, register, length) -> bytes:
+        write = self._smbus2.i2c_msg.write(address, [register])
+        read = self._smbus2.i2c_msg.read(address, length)
+        self._bus.i2c_rdwr(write, read)
+        return bytes(read)
+
+    def close(self):
+        self._bus.close()
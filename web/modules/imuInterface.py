@@ -1,12 +1,55 @@
 import threading
-from math import atan2, pi
+import time
+from math import atan2, pi, sqrt
+
+RAD_TO_DEG = 180 / pi
+
+
+def compass_deg_from_mag(mag):
+    return (atan2(mag[0], mag[1]) * RAD_TO_DEG + 90 + 360) % 360
+
+
+def heel_deg_from_accel(accel):
+    return 180 - (atan2(accel[2], accel[0]) * RAD_TO_DEG + 90 + 360) % 360
+
+
+# Rate of turn in degrees per second, positive turning to starboard: the gyro's rotation about the up axis.
+def yaw_rate_dps_from(gyro, accel):
+    g = sqrt(accel[0] ** 2 + accel[1] ** 2 + accel[2] ** 2)
+    return -(gyro[0] * accel[0] + gyro[1] * accel[1] + gyro[2] * accel[2]) / g if g > 0 else 0.0
+
+
+# Immutable set of IMU readings, all from the same monitor iteration, along with what was derived from them.
+# The monitor publishes a new one by replacing its reference, so readers need no lock, and never see a mix of
+# old and new values, as long as they take the sample once and read all they need from it.
+class ImuSample:
+    __slots__ = ('timestamp', 'accel', 'gyro', 'mag', 'temp', 'heading', 'heel', 'yaw_rate')
+
+    def __init__(self, timestamp, accel, gyro, mag, temp, heading, heel, yaw_rate):
+        set_field = super().__setattr__
+        set_field('timestamp', timestamp)  # time.monotonic() at which the readings were taken. None before the first.
+        set_field('accel', accel)  # Gs
+        set_field('gyro', gyro)  # Degrees per second
+        set_field('mag', mag)  # Microteslas
+        set_field('temp', temp)  # Celsius
+        set_field('heading', heading)  # Degrees
+        set_field('heel', heel)  # Degrees, positive to starboard
+        set_field('yaw_rate', yaw_rate)  # Degrees per second, positive turning to starboard
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"ImuSample is immutable (tried to set '{name}')")
+
+    # Seconds since the readings were taken. None before the first.
+    def get_age(self):
+        return None if self.timestamp is None else time.monotonic() - self.timestamp
+
 
 class imu_interface(object):
     def __init__(self):
         self._monitor_thread = threading.Thread(target=self.monitor)
         self._monitor_thread.daemon = True
         self._check_interval = 1.0/60  # NOTE: IMU data refresh rate is 400kHz on i2c interface (so smallest interval = 1/400000)
-        self._is_running = True
+        self._running = False
 
     def start(self):
         self._running = True
@@ -16,12 +59,20 @@ class imu_interface(object):
         self._running = False
 
     def compass_deg(self):
-        mag = self.mag
-        return (atan2(mag[0], mag[1]) * (180/pi) + 90 + 360) % 360
+        return compass_deg_from_mag(self.mag)
 
     def heel_deg(self):
-        accel = self.accel
-        return 180 - (atan2(accel[2], accel[0]) * (180/pi) + 90 + 360) % 360
+        return heel_deg_from_accel(self.accel)
+
+    def yaw_rate_dps(self):
+        return yaw_rate_dps_from(self.gyro, self.accel)
+
+    # Latest readings, as one consistent ImuSample. Override to publish samples from the monitor rather than
+    # building one from the properties on every call.
+    def get_sample(self) -> ImuSample:
+        accel, gyro, mag = self.accel, self.gyro, self.mag
+        return ImuSample(time.monotonic(), accel, gyro, mag, self.temp,
+                         compass_deg_from_mag(mag), heel_deg_from_accel(accel), yaw_rate_dps_from(gyro, accel))
 
     @property
     def accel(self):
@@ -48,7 +99,7 @@ class imu_interface(object):
 
     @property
     def is_running(self):
-        return self._is_running
+        return self._running
 
     @property
     def check_interval(self):
@@ -0,0 +1,148 @@
+## Adrian Vrouwenvelder
+## April 2023
+
+# Replays a recording made by mpu9250_interface (see imu_recording.py) through the same filters, calibration, gyro
+# bias estimation and fusion as the live driver, so that a passage can be re-run on the desk, as often as needed,
+# with different settings in config.yaml.
+#
+# The recording is opened with numpy.memmap, so even an hour long recording is not read into memory: the OS pages
+# it in as the replay goes. Accel/temp/gyro blocks are decoded a batch at a time with numpy.
+#
+# Run from the web directory:
+#   python3 -m modules.imuReplayInterface recording.imurec --speed 10    # Replay at 10x, printing as it goes
+#   python3 -m modules.imuReplayInterface recording.imurec --speed 0     # As fast as possible
+
+import argparse
+from time import sleep, monotonic, thread_time
+
+import numpy as np
+
+from modules.imuInterface import imu_interface, ImuSample
+from modules.imu_recording import RECORDING_MAGIC, RECORD_SIZE, HEADER_STRUCT, HEADER_SIZE, RECORD_ACCEL_TEMP_GYRO, RECORD_MAG
+from modules.mpu9250Interface import mpu9250_interface, ACCEL_TEMP_GYRO_BLOCK_SIZE, MAG_ST1_ST2_BLOCK_SIZE, \
+    ACCEL_RANGE_CONV, GYRO_RANGE_CONV, TEMP_SENSITIVITY, ROOM_TEMP_OFFSET
+
+RECORD_DTYPE = np.dtype([('time', '<f8'), ('kind', 'u1'), ('data', 'u1', 15)])
+BATCH_RECORDS = 256  # Records decoded at a time: at most this many are applied before the replay checks the clock
+
+
+def open_recording(recording_file) -> np.memmap:
+    with open(recording_file, 'rb') as stream:
+        magic, record_size, _ = HEADER_STRUCT.unpack(stream.read(HEADER_SIZE))
+    if magic != RECORDING_MAGIC or record_size != RECORD_SIZE:
+        raise Exception(f"{recording_file} is not an IMU recording")
+    return np.memmap(recording_file, dtype=RECORD_DTYPE, mode='r', offset=HEADER_SIZE)
+
+
+# Decode accel/temp/gyro blocks (n x 14 bytes, as read from ACCEL_DATA_REG) into Gs, degrees Celsius and dps, as
+# decode_accel_temp_gyro does one block at a time.
+def decode_accel_temp_gyro_array(blocks):
+    raw = np.ascontiguousarray(blocks[:, :ACCEL_TEMP_GYRO_BLOCK_SIZE]).view('>i2').astype(float)
+    accel = raw[:, 0:3] * ACCEL_RANGE_CONV
+    temp = (raw[:, 3] - ROOM_TEMP_OFFSET) / TEMP_SENSITIVITY + 21.0
+    gyro = raw[:, 4:7] * GYRO_RANGE_CONV
+    return accel, temp, gyro
+
+
+class mpu9250_replay_interface(mpu9250_interface):
+    def __init__(self, recording_file, config_file, speed=1.0):
+        """
+        Replay recording_file at speed times real time (0 for as fast as possible), using the settings in config_file.
+        """
+        imu_interface.__init__(self)
+        self.bus = None
+        self._load_config(config_file)
+        self.recording_file = recording_file
+        self.speed = speed
+        self._records = open_recording(recording_file)
+        self.records = len(self._records)
+        self.replayed = 0  # Records replayed so far
+
+    def get_duration_s(self) -> float:
+        if len(self._records) == 0:
+            return 0.0
+        return float(self._records['time'][-1] - self._records['time'][0])
+
+    def is_finished(self) -> bool:
+        return self.replayed == self.records
+
+    # speed only paces the replay. The filters, bias estimator and fusion are given the recorded sample times, moved
+    # (at 1:1) to start at the replay's start, so that they integrate over the same intervals, and so reach the same
+    # results, at any speed. Published samples are stamped on the replay's own monotonic() time line instead, so
+    # that sample ages come out as they did on the boat.
+    #override
+    def monitor(self):
+        print(f"imu9250 replay of {self.recording_file} started ({len(self._records)} records, {self.get_duration_s():.1f}s, speed {self.speed})")
+        records = self._records
+        if len(records) > 0:
+            recording_start_s = float(records['time'][0])
+        replay_start_s = monotonic()
+        while self.is_running and self.replayed < len(records):
+            batch = records[self.replayed:self.replayed + BATCH_RECORDS]
+            times = batch['time'] - recording_start_s
+            if self.speed > 0:
+                # Apply a batch no earlier than its first record is due, and no more of it than is due by then.
+                elapsed_s = (monotonic() - replay_start_s) * self.speed
+                if times[0] > elapsed_s:
+                    sleep(min((times[0] - elapsed_s) / self.speed, 0.1))
+                    continue
+                batch = batch[:max(1, int(np.searchsorted(times, elapsed_s, side='right')))]
+                times = times[:len(batch)]
+            sample_times = replay_start_s + times
+            kinds = batch['kind']
+            is_accel = kinds == RECORD_ACCEL_TEMP_GYRO
+            accel, temp, gyro = decode_accel_temp_gyro_array(batch['data'][is_accel])
+            accel_rows = np.cumsum(is_accel) - 1
+            applied = False
+            for n in range(len(batch)):
+                if kinds[n] == RECORD_ACCEL_TEMP_GYRO:
+                    k = accel_rows[n]
+                    self._apply_accel_temp_gyro(float(sample_times[n]), tuple(accel[k].tolist()), float(temp[k]), tuple(gyro[k].tolist()))
+                    applied = True
+                elif kinds[n] == RECORD_MAG:
+                    applied = self._apply_mag(float(sample_times[n]), bytes(batch['data'][n, :MAG_ST1_ST2_BLOCK_SIZE])) or applied
+            self.replayed += len(batch)
+            if applied:
+                if len(accel) > 0:
+                    last_accel_s = float(times[is_accel][-1])
+                    self._sample_time_s = replay_start_s + last_accel_s / self.speed if self.speed > 0 else monotonic()
+                self._publish_sample()
+            self._rate_window.append((monotonic(), thread_time(), self.samples))
+        self.stop_recording()
+        print(f"imu9250 replay terminated after {self.replayed} records")
+
+    #override
+    def get_stats(self) -> dict:
+        stats = super().get_stats()
+        stats.update(recording_file=self.recording_file,
+                     speed=self.speed,
+                     replayed=self.replayed,
+                     records=self.records)
+        return stats
+
+
+def get_interface(recording_file, config_file="/mnt/mmcblk0p2/apps/adrianAutoPilot/configuration/config.yaml", speed=1.0):
+    return mpu9250_replay_interface(recording_file=recording_file, config_file=config_file, speed=speed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay an IMU recording.")
+    parser.add_argument("recording", help="Recording to replay")
+    parser.add_argument("--config", default="/mnt/mmcblk0p2/apps/adrianAutoPilot/configuration/config.yaml", help="config.yaml to take settings from")
+    parser.add_argument("--speed", type=float, default=1.0, help="Times real time, or 0 for as fast as possible")
+    args = parser.parse_args()
+
+    imu = get_interface(args.recording, config_file=args.config, speed=args.speed)
+    start_s = monotonic()
+    imu.start()
+    try:
+        while not imu.is_finished():
+            sample: ImuSample = imu.get_sample()
+            print(f"{imu.replayed}/{imu.records} heading={sample.heading:.1f} heel={sample.heel:.1f} yaw_rate={sample.yaw_rate:.2f} temp={sample.temp:.1f}")
+            sleep(1)
+    except KeyboardInterrupt:
+        pass
+    imu.stop()
+    sample = imu.get_sample()
+    print(f"Replayed {imu.replayed} records in {monotonic() - start_s:.1f}s: heading={sample.heading:.1f} heel={sample.heel:.1f} yaw_rate={sample.yaw_rate:.2f}")
+    print(f"stats = {imu.get_stats()}")
@@ -0,0 +1,56 @@
+## Adrian Vrouwenvelder
+## April 2023
+
+import struct
+import threading
+
+# IMU recording file: a 16 byte header, then fixed size records, one per raw register block read from the IMU:
+#    time     little endian double: monotonic() seconds at which the block was sampled
+#    kind     byte: RECORD_ACCEL_TEMP_GYRO or RECORD_MAG
+#    data     15 bytes: the block as read from the chip, zero padded
+#               RECORD_ACCEL_TEMP_GYRO: 14 bytes from ACCEL_DATA_REG (or one FIFO record)
+#               RECORD_MAG: 8 bytes from MAG_ST1_REG
+# Fixed size records can be read back with numpy.memmap (see imuReplayInterface.py) without parsing the file.
+RECORDING_MAGIC = b'IMUREC\x00\x01'
+RECORD_STRUCT = struct.Struct('<dB15s')
+RECORD_SIZE = RECORD_STRUCT.size  # 24
+HEADER_STRUCT = struct.Struct('<8sII')  # magic, record size, reserved
+HEADER_SIZE = HEADER_STRUCT.size  # 16
+RECORD_ACCEL_TEMP_GYRO = 0
+RECORD_MAG = 1
+
+
+# Appends records to a recording file. Records are packed into a buffer, and written out batch_records at a time,
+# so that the SD card sees a few large writes rather than hundreds of small ones a second.
+class ImuRecorder:
+
+    def __init__(self, path, batch_records=1024):
+        self.path = path
+        self._batch_size = batch_records * RECORD_SIZE
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._file = open(path, 'wb')
+        self._file.write(HEADER_STRUCT.pack(RECORDING_MAGIC, RECORD_SIZE, 0))
+        self.records = 0
+        self.writes = 0
+
+    def record(self, kind, sample_time_s, data):
+        with self._lock:
+            if self._file.closed:  # Stopped while the monitor was mid-read
+                return
+            self._buffer += RECORD_STRUCT.pack(sample_time_s, kind, bytes(data))
+            self.records += 1
+            if len(self._buffer) >= self._batch_size:
+                self._write()
+
+    def _write(self):
+        self._file.write(self._buffer)
+        self._file.flush()
+        self._buffer.clear()
+        self.writes += 1
+
+    def close(self):
+        with self._lock:
+            if self._buffer and not self._file.closed:
+                self._write()
+            self._file.close()
@@ -0,0 +1,178 @@
+## Adrian Vrouwenvelder
+## April 2023
+
+# Magnetometer hard and soft iron calibration, by fitting an ellipsoid to readings taken while the sensor is turned
+# through as many orientations as possible (on the boat: turning circles while heeled both ways; off the boat:
+# tumbling the sensor in the hand).
+#
+# Iron near the sensor shifts the sphere of readings that a perfect magnetometer would trace (hard iron) and
+# stretches it into an ellipsoid (soft iron). Fitting the ellipsoid gives its centre, the hard iron offset, and the
+# matrix that maps it back onto a sphere, the soft iron correction:
+#    calibrated = soft_iron . (mag * calib - hard_iron)
+# This replaces the per-axis bias and scale in config.yaml, which can only correct an ellipsoid lined up with the
+# sensor's axes.
+#
+# Run from the web directory:
+#   python3 -m modules.mag_calibration --seconds 60 --record mag.csv    # Collect from the MPU9250, and fit
+#   python3 -m modules.mag_calibration --csv mag.csv                     # Fit recorded readings again
+# Add --write to either to put the result into config.yaml (the rest of the file, comments and all, is left as is).
+
+import argparse
+import time
+
+import numpy as np
+
+DEFAULT_CONFIG_FILE = "/mnt/mmcblk0p2/apps/adrianAutoPilot/configuration/config.yaml"
+
+MIN_SAMPLES = 50
+MAX_CONDITION = 1e8  # Beyond this, the readings do not cover enough orientations to pin down all nine parameters
+
+
+# Bounded buffer of magnetometer readings (after the chip's factory calib), preallocated, newest overwriting oldest.
+class MagCalibrator:
+
+    def __init__(self, capacity=3000):
+        self._buffer = np.empty((capacity, 3))
+        self._count = 0
+        self._next = 0
+
+    def add(self, mag):
+        self._buffer[self._next] = mag
+        self._next = (self._next + 1) % len(self._buffer)
+        self._count = min(self._count + 1, len(self._buffer))
+
+    def get_count(self) -> int:
+        return self._count
+
+    def get_samples(self) -> np.ndarray:
+        return self._buffer[:self._count]
+
+    def fit(self):
+        return fit_ellipsoid(self.get_samples())
+
+
+# Least squares fit of the ellipsoid
+#    a x^2 + b y^2 + c z^2 + 2d xy + 2e xz + 2f yz + 2g x + 2h y + 2i z = 1
+# to samples (n x 3). Returns (hard_iron, soft_iron, field_strength): the centre, the symmetric matrix that maps
+# the ellipsoid onto a sphere centred on the origin, and that sphere's radius (the geometric mean of the
+# ellipsoid's semi-axes, so the calibrated readings stay in microteslas).
+# Raises an Exception if the samples do not describe an ellipsoid.
+def fit_ellipsoid(samples):
+    samples = np.asarray(samples, dtype=float)
+    if len(samples) < MIN_SAMPLES:
+        raise Exception(f"Need at least {MIN_SAMPLES} samples to fit, got {len(samples)}")
+    x, y, z = samples[:, 0], samples[:, 1], samples[:, 2]
+    design = np.column_stack((x * x, y * y, z * z, 2 * x * y, 2 * x * z, 2 * y * z, 2 * x, 2 * y, 2 * z))
+    if np.linalg.cond(design) > MAX_CONDITION:
+        raise Exception("Readings do not cover enough orientations. Turn the sensor through more headings and heel angles.")
+    (a, b, c, d, e, f, g, h, i), _, _, _ = np.linalg.lstsq(design, np.ones(len(samples)), rcond=None)
+    quadric = np.array([[a, d, e], [d, b, f], [e, f, c]])
+    centre = -np.linalg.solve(quadric, np.array([g, h, i]))
+    # Moved to the centre, the ellipsoid is (m - centre)' shape (m - centre) = 1
+    shape = quadric / (1 + centre @ quadric @ centre)
+    eigenvalues, eigenvectors = np.linalg.eigh(shape)
+    if np.any(eigenvalues <= 0):
+        raise Exception("Readings do not describe an ellipsoid. Turn the sensor through more headings and heel angles.")
+    field_strength = np.prod(eigenvalues) ** (-1 / 6)
+    soft_iron = field_strength * (eigenvectors @ np.diag(np.sqrt(eigenvalues)) @ eigenvectors.T)
+    return centre, soft_iron, field_strength
+
+
+# Put hard_iron and soft_iron into the mpu9250: mag: section of config_file, replacing bias and scale (or the
+# hard_iron and soft_iron from an earlier calibration). Edits just those lines, so comments and layout are kept.
+def write_calibration(config_file, hard_iron, soft_iron):
+    with open(config_file, 'r') as stream:
+        lines = stream.read().split('\n')
+    hard_iron_line = "    hard_iron: [ " + ", ".join(f"{v:.4f}" for v in hard_iron) + " ]"
+    soft_iron_line = "    soft_iron: [ " + ", ".join("[ " + ", ".join(f"{v:.6f}" for v in row) + " ]" for row in soft_iron) + " ]"
+    section = None
+    mag_start = mag_end = None
+    for n, line in enumerate(lines):
+        if line.strip() == '' or line.lstrip().startswith('#'):
+            continue
+        indent = len(line) - len(line.lstrip())
+        if indent == 0:
+            section = line.split(':')[0]
+        elif section == 'mpu9250' and indent == 2:
+            if line.strip().startswith('mag:'):
+                mag_start = n
+            elif mag_start is not None and mag_end is None:
+                mag_end = n
+    if mag_start is None:
+        raise Exception(f"No mpu9250: mag: section in {config_file}")
+    if mag_end is None:
+        mag_end = len(lines)
+    replaced = []
+    for line in lines[mag_start + 1:mag_end]:
+        key = line.strip().split(':')[0]
+        if key in ('bias', 'hard_iron'):
+            line = hard_iron_line
+        elif key in ('scale', 'soft_iron'):
+            line = soft_iron_line
+        replaced.append(line)
+    if hard_iron_line not in replaced:
+        replaced.insert(0, hard_iron_line)
+    if soft_iron_line not in replaced:
+        replaced.insert(replaced.index(hard_iron_line) + 1, soft_iron_line)
+    lines[mag_start + 1:mag_end] = replaced
+    with open(config_file, 'w') as stream:
+        stream.write('\n'.join(lines))
+
+
+# Collect readings from a running mpu9250_interface for duration_s, as they arrive.
+def collect(imu, duration_s, calibrator: MagCalibrator):
+    calib = imu.mag_calib
+    imu.set_mag_listener(lambda mag: calibrator.add((mag[0] * calib[0], mag[1] * calib[1], mag[2] * calib[2])))
+    try:
+        end_s = time.monotonic() + duration_s
+        while time.monotonic() < end_s:
+            time.sleep(1)
+            print(f"{calibrator.get_count()} readings")
+    finally:
+        imu.set_mag_listener(None)
+
+
+def load_csv(csv_file) -> np.ndarray:
+    return np.loadtxt(csv_file, delimiter=',', skiprows=1, ndmin=2)
+
+
+def save_csv(csv_file, samples):
+    np.savetxt(csv_file, samples, delimiter=',', header='mx,my,mz', comments='', fmt='%.4f')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit magnetometer hard and soft iron calibration.")
+    parser.add_argument("--csv", help="Fit readings recorded with --record, rather than reading the MPU9250")
+    parser.add_argument("--seconds", type=float, default=60, help="Seconds to collect readings from the MPU9250 for")
+    parser.add_argument("--record", help="Save the readings collected from the MPU9250 to this CSV file")
+    parser.add_argument("--config", default=DEFAULT_CONFIG_FILE, help="config.yaml to read, and write with --write")
+    parser.add_argument("--write", action="store_true", help="Write the calibration into config.yaml")
+    args = parser.parse_args()
+
+    imu = None
+    if args.csv:
+        samples = load_csv(args.csv)
+    else:
+        from modules.mpu9250Interface import get_interface
+        imu = get_interface(config_file=args.config)
+        imu.start()
+        print(f"For {args.seconds}s, turn the sensor through every heading, heeled both ways.")
+        calibrator = MagCalibrator()
+        collect(imu, args.seconds, calibrator)
+        samples = calibrator.get_samples()
+        if args.record:
+            save_csv(args.record, samples)
+
+    start_s = time.monotonic()
+    hard_iron, soft_iron, field_strength = fit_ellipsoid(samples)
+    print(f"Fitted {len(samples)} readings in {1000 * (time.monotonic() - start_s):.1f} ms")
+    print(f"hard_iron: {hard_iron.tolist()}")
+    print(f"soft_iron: {soft_iron.tolist()}")
+    print(f"field strength: {field_strength:.2f} uT")
+    residual = np.linalg.norm((samples - hard_iron) @ soft_iron.T, axis=1) - field_strength
+    print(f"Calibrated field strength error: rms {np.sqrt(np.mean(residual ** 2)):.3f} uT, max {np.max(np.abs(residual)):.3f} uT")
+    if args.write:
+        write_calibration(args.config, hard_iron, soft_iron)
+        print(f"Written to {args.config}")
+    if imu is not None:
+        imu.stop()
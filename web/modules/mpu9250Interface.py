@@ -1,9 +1,16 @@
 from __future__ import print_function
 from __future__ import division
-import smbus2 as smbus
-from time import sleep, time
-from ctypes import c_short  # for signed int. c_short is 16 bits, signed (-32768 to 32767)
-from modules.imuInterface import imu_interface
+from collections import deque
+from time import sleep, monotonic, thread_time, strftime
+import os
+import struct
+from modules.imuInterface import imu_interface, ImuSample, compass_deg_from_mag, heel_deg_from_accel, yaw_rate_dps_from
+from modules.scheduler import DeadlineScheduler
+from modules.fusion import ComplementaryFilter
+from modules.filters import make_filter
+from modules.gyro_bias import GyroBiasEstimator
+from modules.i2c_bus import SMBusBackend
+from modules.imu_recording import ImuRecorder, RECORD_ACCEL_TEMP_GYRO, RECORD_MAG
 import yaml
 
 # Enabling the i2c interface for reading the mpu9250
@@ -41,6 +48,24 @@ PWR_MGMT_1_REG = 0x6B
 INT_PIN_CFG_REG = 0x37
 INT_ENABLE_REG = 0x38
 
+# --- Sample rate and FIFO ------------------
+SMPLRT_DIV_REG = 0x19  # Output data rate = internal rate / (1 + SMPLRT_DIV)
+CONFIG_REG = 0x1A  # Bit 6 FIFO_MODE (0 = overwrite oldest data when full), bits 0-2 DLPF_CFG
+CONFIG_DLPF_184HZ = 0x01  # Gyro DLPF at 184Hz. Internal sample rate is 1kHz for DLPF_CFG 1 through 6.
+ACCEL_CONFIG2_DLPF_218HZ = 0x01  # ACCEL_FCHOICE_B = 0, A_DLPF_CFG = 1. Internal sample rate 1kHz.
+INTERNAL_SAMPLE_RATE_HZ = 1000
+FIFO_EN_REG = 0x23
+FIFO_EN_TEMP = 0x80
+FIFO_EN_GYRO = 0x70  # GYRO_XOUT, GYRO_YOUT, GYRO_ZOUT
+FIFO_EN_ACCEL = 0x08
+USER_CTRL_REG = 0x6A
+USER_CTRL_FIFO_EN = 0x40
+USER_CTRL_FIFO_RST = 0x04
+FIFO_COUNTH_REG = 0x72  # FIFO_COUNTH (bits 0-4) followed by FIFO_COUNTL
+FIFO_R_W_REG = 0x74
+FIFO_SIZE = 512
+SMBUS_BLOCK_MAX = 32  # Most bytes read_i2c_block_data can read in one transaction
+
 # --- Accelerometer ------------------
 ACCEL_DATA_REG = 0x3B  # ACCEL_XOUT_H (6 bytes: XH, XL, YH, YL, ZH, ZL in that order)
 
@@ -86,6 +111,7 @@ MAG_SENSITIVITY_REG = 0x10  # ASAX followed by ASAY, ASAZ.
 MAG_CNTL1_REG = 0x0A
 MAG_CNTL1_8HZ = 0x02  # Continuous Measurement Mode 1 = 8
 MAG_CNTL1_100HZ = 0x06  # Continuous Measurement Mode 2
+MAG_CNTL1_MODES = {8: MAG_CNTL1_8HZ, 100: MAG_CNTL1_100HZ}  # Output data rate in Hz -> continuous measurement mode
 MAG_CNTL1_14BIT = 0x00
 MAG_CNTL1_16BIT = 0x10  # 0001 0000  (bit 4)
 # MAG_CNTL2_REG = 0x0B  # SPEC SAYS DO NOT USE
@@ -106,60 +132,193 @@ ROOM_TEMP_OFFSET = 21.0
 TEMP_SENSITIVITY = 333.87
 X, Y, Z = 0, 1, 2
 
-def moving_average_vector(average_vector, val_vector, window_size):
-    rc_vector = [0, 0, 0]
-    for i in range(0, 3):
-       rc_vector[i] = (val_vector[i] + average_vector[i] * (window_size - 1)) / window_size
-    return rc_vector
-
-
-def moving_average_scalar(average, val, window_size):
-    return (val + average * (window_size - 1)) / window_size
-
-
-def c_short_big_endian(msb, lsb):
-    return c_short(lsb | (msb << 8)).value
-
-
-def c_short_little_endian(msb, lsb):
-    return c_short(msb | (lsb << 8)).value
-
-
-def subtr(x, y):
-    return x - y
-
-
-def mult(x, y):
-    return x * y
-
-
-def vector_from_data(data, offset, conversion_factor, c_short_fn):
-    return [c_short_fn(data[0 + offset], data[1 + offset]) * conversion_factor,
-            c_short_fn(data[2 + offset], data[3 + offset]) * conversion_factor,
-            c_short_fn(data[4 + offset], data[5 + offset]) * conversion_factor]
-
-# vop = vector operation. fun defines the operation.
-def v_op(fun, vector1, vector2):
-    if len(vector1) != len(vector2):
-        raise Exception(f"{vector1} and {vector2} are not the same length")
-    result_vector = [0] * len(vector1)
-    for i, d in enumerate(vector1):
-        result_vector[i] = fun(d, vector2[i])
-    return result_vector
+# Block read from ACCEL_DATA_REG: accel X, Y, Z, temp, gyro X, Y, Z. Seven big endian signed shorts.
+ACCEL_TEMP_GYRO_STRUCT = struct.Struct('>7h')
+ACCEL_TEMP_GYRO_BLOCK_SIZE = ACCEL_TEMP_GYRO_STRUCT.size  # 14
+# Block read from MAG_ST1_REG: the ST1 register, mag X, Y, Z (little endian signed shorts), then the ST2 register.
+# Reading through to ST2 is what releases the data registers for the next measurement.
+MAG_ST1_ST2_STRUCT = struct.Struct('<B3hB')
+MAG_ST1_ST2_BLOCK_SIZE = MAG_ST1_ST2_STRUCT.size  # 8
+# With accel, temp and gyro enabled in FIFO_EN, each FIFO record is laid out as the ACCEL_DATA_REG block.
+FIFO_RECORD_SIZE = ACCEL_TEMP_GYRO_BLOCK_SIZE
+# Largest plain block read that holds whole records.
+FIFO_CHUNK_SIZE = SMBUS_BLOCK_MAX // FIFO_RECORD_SIZE * FIFO_RECORD_SIZE  # 28
+
+
+# y = matrix . x + offset, for 3-vectors. Calibration from config.yaml is folded into one of these at load time,
+# so that applying it to a sample costs nine multiplies and no intermediate lists.
+class AffineTransform:
+    __slots__ = ('_m', )
+
+    # matrix: 3 rows of 3. offset: 3 values.
+    def __init__(self, matrix, offset):
+        (m00, m01, m02), (m10, m11, m12), (m20, m21, m22) = matrix
+        self._m = (float(m00), float(m01), float(m02), float(m10), float(m11), float(m12),
+                   float(m20), float(m21), float(m22), float(offset[0]), float(offset[1]), float(offset[2]))
+
+    @staticmethod
+    def diagonal(gain, offset):
+        return AffineTransform(((gain[0], 0, 0), (0, gain[1], 0), (0, 0, gain[2])), offset)
+
+    def apply(self, v):
+        x, y, z = v
+        m00, m01, m02, m10, m11, m12, m20, m21, m22, o0, o1, o2 = self._m
+        return (m00 * x + m01 * y + m02 * z + o0,
+                m10 * x + m11 * y + m12 * z + o1,
+                m20 * x + m21 * y + m22 * z + o2)
+
+
+# With hard_iron and soft_iron (fitted by mag_calibration.py):
+#    soft_iron . (mag * calib - hard_iron)  ==  (soft_iron . diag(calib)) . mag - soft_iron . hard_iron
+# Otherwise, with the per-axis bias and scale:
+#    (mag * calib - bias) * scale  ==  mag * (calib * scale) - bias * scale
+def mag_calibration_transform(mag_config):
+    calib = mag_config['calib']
+    if 'soft_iron' in mag_config:
+        soft_iron, hard_iron = mag_config['soft_iron'], mag_config['hard_iron']
+        matrix = [[soft_iron[row][col] * calib[col] for col in range(3)] for row in range(3)]
+        offset = [-sum(soft_iron[row][col] * hard_iron[col] for col in range(3)) for row in range(3)]
+        return AffineTransform(matrix, offset)
+    bias, scale = mag_config['bias'], mag_config['scale']
+    return AffineTransform.diagonal([calib[i] * scale[i] for i in range(3)], [-bias[i] * scale[i] for i in range(3)])
+
+
+# vector - bias
+def bias_transform(bias):
+    return AffineTransform.diagonal([1, 1, 1], [-b for b in bias])
+
+
+# Decode an ACCEL_DATA_REG block (list of bytes, as read from the bus) into accel (Gs), temp (Celsius) and gyro (dps).
+def decode_accel_temp_gyro(data):
+    ax, ay, az, t, gx, gy, gz = ACCEL_TEMP_GYRO_STRUCT.unpack(bytes(data))
+    return ((ax * ACCEL_RANGE_CONV, ay * ACCEL_RANGE_CONV, az * ACCEL_RANGE_CONV),
+            (t - ROOM_TEMP_OFFSET) / TEMP_SENSITIVITY + 21.0,
+            (gx * GYRO_RANGE_CONV, gy * GYRO_RANGE_CONV, gz * GYRO_RANGE_CONV))
+
+
+# Decode consecutive ACCEL_DATA_REG blocks (e.g. drained from the FIFO) into a list of (accel, temp, gyro).
+def decode_accel_temp_gyro_batch(data):
+    return [((ax * ACCEL_RANGE_CONV, ay * ACCEL_RANGE_CONV, az * ACCEL_RANGE_CONV),
+             (t - ROOM_TEMP_OFFSET) / TEMP_SENSITIVITY + 21.0,
+             (gx * GYRO_RANGE_CONV, gy * GYRO_RANGE_CONV, gz * GYRO_RANGE_CONV))
+            for ax, ay, az, t, gx, gy, gz in ACCEL_TEMP_GYRO_STRUCT.iter_unpack(bytes(data))]
+
+
+# Decode a MAG_ST1_REG block (list of bytes, as read from the bus) into ST1 and mag (microteslas).
+# mag is None on magnetic overflow, when the reading is not valid. It is only new if ST1 has DRDY set.
+def decode_mag(data):
+    st1, mx, my, mz, st2 = MAG_ST1_ST2_STRUCT.unpack(bytes(data))
+    if st2 & MAG_ST2_MAG_OVERFLOW:
+        return st1, None
+    return st1, (mx * MAG_RANGE_CONV, my * MAG_RANGE_CONV, mz * MAG_RANGE_CONV)
+
+
+DEADLINE_SLACK_S = 1e-6  # Allows for rounding, when comparing monitor deadlines with the times reads are due
+
+
+# Time the next read is due: period_s after the one due at due_s, skipping any whole periods the monitor iteration
+# with deadline deadline_s has fallen behind by. Following on from the previous due time, rather than from the
+# time of the read, keeps reads in step with the chip however late the monitor wakes.
+def next_due_s(due_s, deadline_s, period_s):
+    return due_s + (max(0.0, deadline_s - due_s) // period_s + 1) * period_s
 
 
 class mpu9250_interface(imu_interface):
-    def __init__(self, bus, config_file):
+    def __init__(self, bus, config_file, i2c_bus=None):
         """
-        Initialize the IMU
+        Initialize the IMU, on I2C bus number bus, or on i2c_bus (see i2c_bus.py) if given
         """
         super().__init__()
+        self.bus = None
+        self._load_config(config_file)
+        self.bus = SMBusBackend(bus) if i2c_bus is None else i2c_bus
+        self._init_device()
+        if self.recording['enabled']:
+            self.start_recording()
+
+    # Everything but the device: state, and the settings, calibration, filters and fusion from config.yaml.
+    def _load_config(self, config_file):
         self._mag = None
         self._gyro = None
         self._temp = None
         self._accel = None
-        self.bus = smbus.SMBus(bus)
+        self._mag_avg = [0] * 3
+        self._gyro_avg = [0] * 3
+        self._accel_avg = [0] * 3
+        self._temp_avg = (0, )
+        self._sample_time_s = None  # monotonic() at which the latest accel/temp/gyro sample was taken
+        self.samples = 0
+        self.i2c_transactions = 0
+        self.fifo_resets = 0
+        self._mag_next_read_s = 0  # Monitor deadline from which the next mag measurement should be ready
+        self._mag_schedule_known = False  # Whether _mag_next_read_s is in step with the chip's measurements
+        self._accel_next_read_s = 0  # Monitor deadline from which the next accel/temp/gyro read (or FIFO drain) is due
+        self.mag_reads = 0
+        self.mag_fresh = 0
+        self.mag_stale = 0
+        self.mag_overflows = 0
+        self.mag_data_overruns = 0
+        self._mag_listener = None
+        self._recorder: ImuRecorder = None
 
+        with open(config_file, 'r') as stream:
+            mpu = yaml.safe_load(stream)["mpu9250"]
+            gyro = mpu['gyro']
+            accel = mpu['accel']
+            temp = mpu['temp']
+            mag = mpu['mag']
+            self.gyro_bias = gyro['bias']
+            self.accel_bias = accel['bias']
+            self.temp_bias = temp['bias']
+            self.mag_calib = mag['calib']
+            self.mag_odr_hz = mag['odr']
+            if self.mag_odr_hz not in MAG_CNTL1_MODES:
+                raise Exception(f"AK8963: unsupported output data rate {self.mag_odr_hz} Hz. Use one of {list(MAG_CNTL1_MODES)}")
+            self.target_sample_rate_hz = mpu['sample_rate']
+            self.stats_window = mpu['stats_window']
+            estimation = gyro['bias_estimation']
+            self.gyro_bias_estimator = None
+            if estimation['enabled']:
+                self.gyro_bias_estimator = GyroBiasEstimator(self.gyro_bias,
+                                                             estimation['still_gyro_std'],
+                                                             estimation['still_accel_std'],
+                                                             estimation['still_max_rate'],
+                                                             estimation['still_time'],
+                                                             estimation['detect_time_constant'],
+                                                             estimation['learn_time_constant'],
+                                                             estimation['min_temp_range'],
+                                                             estimation['prior_time'])
+            fusion = mpu['fusion']
+            self.fusion_enabled = fusion['enabled']
+            self.fusion = ComplementaryFilter(fusion['heading_time_constant'], fusion['heel_time_constant'])
+            fifo = mpu['fifo']
+            self.fifo_enabled = fifo['enabled']
+            self.fifo_odr_hz = fifo['odr']
+            self.fifo_drain_interval_s = fifo['drain_interval'] / 1000
+            self.fifo_burst_read = fifo['burst_read']
+            self.recording = mpu['recording']
+        self._gyro_bias = tuple(self.gyro_bias)  # Current bias: as configured, or as estimated for the current temperature
+        self._accel_transform = bias_transform(self.accel_bias)
+        self._mag_transform = mag_calibration_transform(mag)
+        # Smoothing, per channel (see filters.py). The _avg values above are the filters' latest outputs.
+        sample_rate_hz = self.fifo_odr_hz if self.fifo_enabled else self.target_sample_rate_hz
+        self._gyro_filter = make_filter(gyro, 3, sample_rate_hz)
+        self._accel_filter = make_filter(accel, 3, sample_rate_hz)
+        self._temp_filter = make_filter(temp, 1, sample_rate_hz)
+        self._mag_filter = make_filter(mag, 3, self.mag_odr_hz)
+        self._sample: ImuSample = None
+        self._publish_sample()
+        self._mag_period_s = 1 / self.mag_odr_hz
+        # The monitor reads the registers at sample_rate, or drains the FIFO every drain_interval. It wakes as often
+        # as that, or as a new mag measurement is due, whichever is more often, so that no mag measurement is
+        # skipped because the loop runs slower than the mag (e.g. one FIFO drain per five measurements).
+        self._accel_interval_s = self.fifo_drain_interval_s if self.fifo_enabled else 1 / self.target_sample_rate_hz
+        self._scheduler = DeadlineScheduler(min(self._accel_interval_s, self._mag_period_s), self.stats_window)
+        # (monotonic(), monitor thread's CPU time, samples) after each of the recent monitor iterations.
+        self._rate_window = deque(maxlen=self.stats_window)
+
+    # Find the MPU9250 and AK8963 and set them up to sample as configured.
+    def _init_device(self):
         if self.bus.read_byte_data(MPU9250_ADDRESS, MPU9250_WHO_AM_I_REG) is not MPU9250_DEVICE_ID:
             raise Exception('MPU9250: init failed to find device')
 
@@ -178,91 +337,293 @@ class mpu9250_interface(imu_interface):
 
         if self.bus.read_byte_data(AK8963_ADDRESS, AK8963_WHO_AM_I_REG) is not AK8963_DEVICE_ID:
             raise Exception('AK8963: init failed to find device')
-        self.bus.write_byte_data(AK8963_ADDRESS, MAG_CNTL1_REG, (MAG_CNTL1_16BIT | MAG_CNTL1_8HZ))  # cont mode 1
         self.bus.write_byte_data(AK8963_ADDRESS, MAG_SELF_TEST_REG, 0)
 
-        self._mag_avg = [0] * 3
-        self._gyro_avg = [0] * 3
-        self._accel_avg = [0] * 3
-        self._temp_avg = 0
-
-
-        with open(config_file, 'r') as stream:
-            mpu = yaml.safe_load(stream)["mpu9250"]
-            gyro = mpu['gyro']
-            accel = mpu['accel']
-            temp = mpu['temp']
-            mag = mpu['mag']
-            self.gyro_bias = gyro['bias']
-            self.accel_bias = accel['bias']
-            self.temp_bias = temp['bias']
-            self.mag_bias = mag['bias']
-            self.mag_scale = mag['scale']
-            self.mag_calib = mag['calib']
-            self.moving_average_window_size_gyro = gyro['moving_average_window_size']
-            self.moving_average_window_size_accel = accel['moving_average_window_size']
-            self.moving_average_window_size_temp = temp['moving_average_window_size']
-            self.moving_average_window_size_mag = mag['moving_average_window_size']
-        self.sample_rate_hz = 0
-
+        self.bus.write_byte_data(AK8963_ADDRESS, MAG_CNTL1_REG, (MAG_CNTL1_16BIT | MAG_CNTL1_MODES[self.mag_odr_hz]))  # continuous mode
+        if self.fifo_enabled:
+            self._enable_fifo()
 
     def __del__(self):
+        if self.bus is None:
+            return
         self.bus.write_byte_data(MPU9250_ADDRESS, PWR_MGMT_1_REG, 0x00)  # turn MPU mode off
         self.bus.close()
         print("Bus closed. MPU off.")
 
+    # Calibrate the averages, derive heading, heel and yaw rate from them (or take them from the fusion filter),
+    # and publish the lot as one immutable ImuSample. Replacing the reference is atomic, so a reader that takes
+    # the sample once never mixes values from different monitor iterations. Called once per monitor iteration.
+    def _publish_sample(self):
+        accel = self._accel_transform.apply(self._accel_avg)
+        gyro_avg, gyro_bias = self._gyro_avg, self._gyro_bias
+        gyro = (gyro_avg[0] - gyro_bias[0], gyro_avg[1] - gyro_bias[1], gyro_avg[2] - gyro_bias[2])
+        mag = self._mag_transform.apply(self._mag_avg)
+        fusion = self.fusion
+        fused = self.fusion_enabled and fusion.get_heading_deg() is not None and fusion.get_heel_deg() is not None
+        self._sample = ImuSample(timestamp=self._sample_time_s,
+                                 accel=accel,
+                                 gyro=gyro,
+                                 mag=mag,
+                                 temp=self._temp_avg[0] - self.temp_bias,
+                                 heading=fusion.get_heading_deg() if fused else compass_deg_from_mag(mag),
+                                 heel=fusion.get_heel_deg() if fused else heel_deg_from_accel(accel),
+                                 yaw_rate=fusion.get_yaw_rate_dps() if fused else yaw_rate_dps_from(gyro, accel))
+
+    # FIFO mode: the chip samples accel, temp and gyro at exactly fifo_odr_hz into its 512 byte FIFO,
+    # and the monitor drains whatever has queued up every drain interval, in as few transactions as possible.
+    def _enable_fifo(self):
+        divider = round(INTERNAL_SAMPLE_RATE_HZ / self.fifo_odr_hz) - 1
+        if not 0 <= divider <= 255:
+            raise Exception(f"MPU9250: unsupported FIFO output data rate {self.fifo_odr_hz} Hz")
+        self.fifo_odr_hz = INTERNAL_SAMPLE_RATE_HZ / (divider + 1)
+        self._fifo_period_s = 1 / self.fifo_odr_hz
+        self.bus.write_byte_data(MPU9250_ADDRESS, CONFIG_REG, CONFIG_DLPF_184HZ)
+        self.bus.write_byte_data(MPU9250_ADDRESS, ACCEL_CONFIG2_REG, ACCEL_CONFIG2_DLPF_218HZ)
+        self.bus.write_byte_data(MPU9250_ADDRESS, SMPLRT_DIV_REG, divider)
+        self.bus.write_byte_data(MPU9250_ADDRESS, FIFO_EN_REG, FIFO_EN_TEMP | FIFO_EN_GYRO | FIFO_EN_ACCEL)
+        self._reset_fifo()
+
+    def _reset_fifo(self):
+        self.bus.write_byte_data(MPU9250_ADDRESS, USER_CTRL_REG, USER_CTRL_FIFO_RST)
+        self.bus.write_byte_data(MPU9250_ADDRESS, USER_CTRL_REG, USER_CTRL_FIFO_EN)
+        self.i2c_transactions += 2
+        self.fifo_resets += 1
+        # The first record lands one period after the reset.
+        self._fifo_next_sample_s = monotonic() + self._fifo_period_s
+
+    def _read_fifo_count(self) -> int:
+        high, low = self.bus.read_i2c_block_data(MPU9250_ADDRESS, FIFO_COUNTH_REG, 2)
+        self.i2c_transactions += 1
+        return ((high & 0x1F) << 8) | low
+
+    # Read count bytes from the FIFO. In one transaction where the adapter allows it, otherwise in
+    # SMBus sized chunks of whole records.
+    def _read_fifo(self, count) -> bytes:
+        if self.fifo_burst_read:
+            try:
+                data = self.bus.read_burst(MPU9250_ADDRESS, FIFO_R_W_REG, count)
+                self.i2c_transactions += 1
+                return data
+            except OSError as e:
+                print(f"MPU9250: burst FIFO read failed ({str(e)}). Falling back to {FIFO_CHUNK_SIZE} byte reads.")
+                self.fifo_burst_read = False
+        data = bytearray()
+        while len(data) < count:
+            data += bytes(self.bus.read_i2c_block_data(MPU9250_ADDRESS, FIFO_R_W_REG, min(FIFO_CHUNK_SIZE, count - len(data))))
+            self.i2c_transactions += 1
+        return bytes(data)
+
+    # Drain all whole records queued in the FIFO. Returns [(timestamp, accel, temp, gyro)], oldest first.
+    # Timestamps are spaced exactly one ODR period apart. They follow on from the previous drain, and are only
+    # re-anchored to the host clock if they have drifted more than a period from it (the chip's clock is not exact).
+    def _drain_fifo(self):
+        count = self._read_fifo_count()
+        if count >= FIFO_SIZE - FIFO_RECORD_SIZE:
+            # Full (or nearly), so records have been overwritten and their timing is lost. Start again.
+            print("MPU9250: FIFO overflow. Resetting FIFO.")
+            self._reset_fifo()
+            return []
+        count -= count % FIFO_RECORD_SIZE
+        if count == 0:
+            return []
+        now_s = monotonic()
+        data = self._read_fifo(count)
+        samples = decode_accel_temp_gyro_batch(data)
+        period_s = self._fifo_period_s
+        last_sample_s = self._fifo_next_sample_s + (len(samples) - 1) * period_s
+        if last_sample_s > now_s or last_sample_s < now_s - 2 * period_s:
+            last_sample_s = now_s
+        first_sample_s = last_sample_s - (len(samples) - 1) * period_s
+        self._fifo_next_sample_s = last_sample_s + period_s
+        recorder = self._recorder
+        if recorder is not None:
+            for k in range(len(samples)):
+                recorder.record(RECORD_ACCEL_TEMP_GYRO, first_sample_s + k * period_s, data[k * FIFO_RECORD_SIZE:(k + 1) * FIFO_RECORD_SIZE])
+        return [(first_sample_s + k * period_s, accel, temp, gyro) for k, (accel, temp, gyro) in enumerate(samples)]
+
+    def _apply_accel_temp_gyro(self, sample_time_s, accel, temp, gyro):
+        self._sample_time_s = sample_time_s
+        self._accel, self._temp, self._gyro = accel, temp, gyro
+        self._gyro_avg = self._gyro_filter.update(gyro)
+        self._accel_avg = self._accel_filter.update(accel)
+        self._temp_avg = self._temp_filter.update((temp, ))
+        accel = self._accel_transform.apply(accel)
+        if self.gyro_bias_estimator is not None:
+            self._gyro_bias = self.gyro_bias_estimator.update(sample_time_s, gyro, accel, temp)
+        if self.fusion_enabled:
+            gyro_bias = self._gyro_bias
+            self.fusion.update_accel_gyro(sample_time_s, accel, (gyro[0] - gyro_bias[0], gyro[1] - gyro_bias[1], gyro[2] - gyro_bias[2]))
+        self.samples += 1
+
+    # The AK8963 only measures at mag_odr_hz (8 or 100 Hz), so it is only read once a new measurement is due,
+    # and the reading is only used if DRDY says it is new. Status and data come in one transaction.
+    # deadline_s is the monitor iteration's deadline. Reads are scheduled on deadlines, rather than on the times they
+    # were made, so that jitter in when the monitor wakes cannot put a read off by a whole iteration (and miss a
+    # measurement).
+    # Returns True if a new reading was applied.
+    def _read_mag(self, deadline_s) -> bool:
+        if deadline_s < self._mag_next_read_s - DEADLINE_SLACK_S:
+            return False
+        now_s = monotonic()
+        data = self.bus.read_i2c_block_data(AK8963_ADDRESS, MAG_ST1_REG, MAG_ST1_ST2_BLOCK_SIZE)  # Read ST1, Magnetometer and ST2
+        self.i2c_transactions += 1
+        self.mag_reads += 1
+        if not data[0] & MAG_ST1_DRDY:
+            # Not ready yet (the chip's clock is not exact). Try again next iteration, and take the schedule from the
+            # iteration the measurement turns up in.
+            self.mag_stale += 1
+            self._mag_schedule_known = False
+            return False
+        if self._mag_schedule_known:
+            self._mag_next_read_s = next_due_s(self._mag_next_read_s, deadline_s, self._mag_period_s)
+        else:
+            self._mag_next_read_s = deadline_s + self._mag_period_s
+            self._mag_schedule_known = True
+        return self._apply_mag(now_s, data)
+
+    # A new MAG_ST1_REG block, read at sample_time_s. Returns True if the reading was applied.
+    def _apply_mag(self, sample_time_s, data) -> bool:
+        if self._recorder is not None:
+            self._recorder.record(RECORD_MAG, sample_time_s, data)
+        st1, mag = decode_mag(data)
+        if st1 & MAG_ST1_DOR:  # A measurement was missed since the last read.
+            self.mag_data_overruns += 1
+        if mag is None:  # Ignore magnetic overflows.
+            self.mag_overflows += 1
+            return False
+        self.mag_fresh += 1
+        self._mag = mag
+        listener = self._mag_listener
+        if listener is not None:
+            listener(mag)
+        self._mag_avg = self._mag_filter.update(mag)
+        if self.fusion_enabled:
+            self.fusion.update_mag(sample_time_s, self._mag_transform.apply(mag))
+        return True
+
     def monitor(self):
-        print("imu9250 monitor started")
-        iterations = 0
-        start_time_s = time()
-        first_gyro_reading = True
-        first_accel_reading = True
-        first_temp_reading = True
-        first_mag_reading = True
+        print(f"imu9250 monitor started ({'FIFO at ' + str(self.fifo_odr_hz) + ' Hz' if self.fifo_enabled else 'register'} mode)")
         while (self.is_running):
-            iterations += 1
-            data = self.bus.read_i2c_block_data(MPU9250_ADDRESS, ACCEL_DATA_REG, 14)  # Read Accel, Temp, and Gyro
-            self._gyro = vector_from_data(data, GYRO_OFFSET, GYRO_RANGE_CONV, c_short_fn=c_short_big_endian)
-            self._gyro_avg = self._gyro if first_gyro_reading else moving_average_vector(self._gyro_avg, self._gyro, self.moving_average_window_size_gyro)
-            first_gyro_reading = False
-            self._accel = vector_from_data(data, ACCEL_OFFSET, ACCEL_RANGE_CONV, c_short_fn=c_short_big_endian)
-            self._accel_avg = self._accel if first_accel_reading else moving_average_vector(self._accel_avg, self._accel, self.moving_average_window_size_accel)
-            first_accel_reading = False
-            self._temp = (c_short_big_endian(data[TEMP_OFFSET], data[TEMP_OFFSET + 1]) - ROOM_TEMP_OFFSET) / TEMP_SENSITIVITY + 21.0
-            self._temp_avg = self._temp if first_temp_reading else moving_average_scalar(self._temp_avg, self._temp, self.moving_average_window_size_temp)
-            first_temp_reading = False
-            data = self.bus.read_i2c_block_data(AK8963_ADDRESS, MAG_DATA_REG, 7)  # Read Magnetometer and ST2
-            if not MAG_ST2_MAG_OVERFLOW & data[6]:  # data[6] is MAG_ST2_REGISTER. Ignore magnetic overflows.
-                self._mag = vector_from_data(data, 0, MAG_RANGE_CONV, c_short_fn=c_short_little_endian)
-                self._mag_avg = self._mag if first_mag_reading else moving_average_vector(self._mag_avg, self._mag, self.moving_average_window_size_mag)
-                first_mag_reading = False
-            self.sample_rate_hz = iterations / (time() - start_time_s)
-            if iterations > 1000:
-                # Occasionally reset start time and iterations to avoid sample_rate_hz getting too heavily based on the past.
-                iterations = 0
-                start_time_s = time()
+            deadline_s = self._scheduler.wait()
+            samples = []
+            if deadline_s >= self._accel_next_read_s - DEADLINE_SLACK_S:  # Otherwise, woken for the mag only
+                self._accel_next_read_s = next_due_s(self._accel_next_read_s, deadline_s, self._accel_interval_s)
+                if self.fifo_enabled:
+                    samples = self._drain_fifo()
+                else:
+                    data = self.bus.read_i2c_block_data(MPU9250_ADDRESS, ACCEL_DATA_REG, ACCEL_TEMP_GYRO_BLOCK_SIZE)  # Read Accel, Temp, and Gyro
+                    self.i2c_transactions += 1
+                    sample_time_s = monotonic()
+                    if self._recorder is not None:
+                        self._recorder.record(RECORD_ACCEL_TEMP_GYRO, sample_time_s, data)
+                    samples = [(sample_time_s, *decode_accel_temp_gyro(data))]
+            for sample in samples:
+                self._apply_accel_temp_gyro(*sample)
+            new_mag = self._read_mag(deadline_s)
+            if len(samples) > 0 or new_mag:
+                self._publish_sample()
+            self._scheduler.done()
+            self._rate_window.append((monotonic(), thread_time(), self.samples))
+        self.stop_recording()
         print("imu9250 monitor terminated")
 
+    # Record every raw register block read from here on to path (see imu_recording.py), or to a new file in the
+    # configured directory if no path is given. Returns the path.
+    def start_recording(self, path=None) -> str:
+        if path is None:
+            os.makedirs(self.recording['directory'], exist_ok=True)
+            path = os.path.join(self.recording['directory'], strftime("imu_%Y%m%d_%H%M%S.imurec"))
+        self.stop_recording()
+        self._recorder = ImuRecorder(path, self.recording['batch_records'])
+        print(f"MPU9250: recording to {path}")
+        return path
+
+    def stop_recording(self):
+        recorder, self._recorder = self._recorder, None
+        if recorder is not None:
+            recorder.close()
+
+    # Have listener(mag) called, on the monitor thread, with every new uncalibrated magnetometer reading (as used by
+    # mag_calibration.py). None to stop.
+    def set_mag_listener(self, listener):
+        self._mag_listener = listener
+
+    #override
+    def get_sample(self) -> ImuSample:
+        return self._sample
+
+    # Accel/temp/gyro samples per second, over the recent stats window.
+    @property
+    def sample_rate_hz(self) -> float:
+        window = self._rate_window
+        if len(window) < 2:
+            return 0.0
+        (start_s, _, start_samples), (end_s, _, end_samples) = window[0], window[-1]
+        return (end_samples - start_samples) / (end_s - start_s)
+
+    # Percentage of one core used by the monitor thread, over the recent stats window.
+    def get_cpu_percent(self) -> float:
+        window = self._rate_window
+        if len(window) < 2:
+            return 0.0
+        (start_s, start_cpu_s, _), (end_s, end_cpu_s, _) = window[0], window[-1]
+        return 100 * (end_cpu_s - start_cpu_s) / (end_s - start_s)
+
+    def get_stats(self) -> dict:
+        return dict(mode="fifo" if self.fifo_enabled else "register",
+                    odr_hz=self.fifo_odr_hz if self.fifo_enabled else None,
+                    burst_read=self.fifo_burst_read if self.fifo_enabled else None,
+                    target_sample_rate_hz=self.fifo_odr_hz if self.fifo_enabled else self.target_sample_rate_hz,
+                    sample_rate_hz=self.sample_rate_hz,
+                    cpu_percent=self.get_cpu_percent(),
+                    samples=self.samples,
+                    i2c_transactions=self.i2c_transactions,
+                    i2c_transactions_per_sample=self.i2c_transactions / self.samples if self.samples > 0 else None,
+                    fifo_resets=self.fifo_resets,
+                    mag_odr_hz=self.mag_odr_hz,
+                    mag_reads=self.mag_reads,
+                    mag_fresh=self.mag_fresh,
+                    mag_stale=self.mag_stale,
+                    mag_overflows=self.mag_overflows,
+                    mag_data_overruns=self.mag_data_overruns,
+                    gyro_bias=list(self._gyro_bias),
+                    gyro_bias_estimation=self.gyro_bias_estimator.get_stats() if self.gyro_bias_estimator is not None else None,
+                    recording=self._recorder.path if self._recorder is not None else None,
+                    monitor=self._scheduler.get_stats())
+
+    # The getters below all read the latest published sample. With fusion enabled, its heading, heel and yaw rate
+    # come from the complementary filter, once that has its first readings.
+    #override
+    def compass_deg(self):
+        return self._sample.heading
+
+    #override
+    def heel_deg(self):
+        return self._sample.heel
+
+    #override
+    def yaw_rate_dps(self):
+        return self._sample.yaw_rate
+
     @property
     def accel(self):
-        return v_op(subtr, self._accel_avg, self.accel_bias)
+        return self._sample.accel
 
     @property
     def gyro(self):
-        return v_op(subtr, self._gyro_avg, self.gyro_bias)
+        return self._sample.gyro
 
     @property
     def mag(self):
-        # (mag_avg * mag_calib - mag_bias) * mag_scale
-        return v_op(mult, v_op(subtr, v_op(mult, self._mag_avg, self.mag_calib), self.mag_bias), self.mag_scale)
+        return self._sample.mag
 
     @property
     def temp(self):
-        return subtr(self._temp_avg, self.temp_bias)
+        return self._sample.temp
 
 
-def get_interface(bus=1, config_file="/mnt/mmcblk0p2/apps/adrianAutoPilot/configuration/config.yaml"):
-    return mpu9250_interface(bus=bus, config_file=config_file)
+def get_interface(bus=1, config_file="/mnt/mmcblk0p2/apps/adrianAutoPilot/configuration/config.yaml", i2c_bus=None):
+    return mpu9250_interface(bus=bus, config_file=config_file, i2c_bus=i2c_bus)
 
 
 
@@ -273,6 +634,7 @@ if __name__ == "__main__":
     try:
         while True:
             print(f'sample_freq={imu.sample_rate_hz} hz')
+            print(f'stats = {imu.get_stats()}')
             print(f'g = {imu.gyro} dps')
             print(f'a = {imu.accel} G')
             print(f't = {imu.temp} C')
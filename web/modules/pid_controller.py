@@ -1,6 +1,9 @@
-from anglemath import calculate_angle_difference
-# import time  # Use this time for production.
-from island_time import time  # Make things simulate faster TODO FOR TESTING ONLY!
+try:
+    from modules.anglemath import calculate_angle_difference
+    from modules.clock import REAL_CLOCK
+except ImportError:  # Run alongside the simulator, rather than as part of the web app.
+    from anglemath import calculate_angle_difference
+    from clock import REAL_CLOCK
 
 # Author: Adrian Vrouwenvelder
 #
@@ -34,11 +37,13 @@ from island_time import time  # Make things simulate faster TODO FOR TESTING ONL
 
 class PID:
   
-    def __init__(self, p_gain, i_gain, d_gain, sampling_interval_ms):
+    # clock (see clock.py) is what wait() sleeps on: real time, unless a simulation passes its VirtualClock.
+    def __init__(self, p_gain, i_gain, d_gain, sampling_interval_ms, clock=REAL_CLOCK):
         self.p_gain = p_gain # Tunable Proportional gain
         self.i_gain = i_gain # Tunable Integral gain
         self.d_gain = d_gain # Tunable Derivative gain
         self.dt = sampling_interval_ms # Sample interval, in ms
+        self.clock = clock
 
         self.err = 0 # error (e.g. smallest angle between actual heading and desired heading)
         self.prev_err = 0 # Previous error
@@ -62,7 +67,7 @@ class PID:
         return self.p_val + self.i_val + self.d_val
 
     def wait(self):
-        time.sleep(self.dt / 1000)  # Convert dt (in ms) to seconds.
+        self.clock.sleep(self.dt / 1000)  # Convert dt (in ms) to seconds.
 
 def test_pv(target, p_gain, i_gain, d_gain, pv):
     pid = PID(p_gain, i_gain, d_gain, 10)
@@ -0,0 +1,107 @@
+## Adrian Vrouwenvelder
+## March 2023
+
+from collections import deque
+
+from modules.clock import REAL_CLOCK
+
+
+# Nearest-rank percentile of an already-sorted, non-empty list. 0 <= pct <= 100.
+def _nearest_rank(sorted_samples, pct):
+    return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * pct / 100))]
+
+
+# Running statistics over a window of recent timing samples (in seconds).
+# Adding a sample is O(1); percentiles are only computed (by sorting the window) when asked for.
+class TimingStats:
+
+    def __init__(self, window_size=600):
+        self._samples = deque(maxlen=window_size)
+        self._count = 0
+        self._max = 0.0
+
+    def add(self, sample_s: float):
+        self._samples.append(sample_s)
+        self._count += 1
+        if sample_s > self._max:
+            self._max = sample_s
+
+    def get_count(self) -> int:
+        return self._count
+
+    # Nearest-rank percentile over the recent window. 0 <= pct <= 100.
+    def percentile(self, pct: float) -> float:
+        samples = sorted(self._samples)
+        return _nearest_rank(samples, pct) if len(samples) > 0 else 0.0
+
+    # Summary in milliseconds. max is over all samples ever added; the rest are over the recent window.
+    def summary_ms(self) -> dict:
+        samples = sorted(self._samples)
+        n = len(samples)
+        if n == 0:
+            return dict(count=self._count, mean=0.0, p50=0.0, p95=0.0, p99=0.0, max=0.0)
+        return dict(count=self._count,
+                    mean=1000 * sum(samples) / n,
+                    p50=1000 * _nearest_rank(samples, 50),
+                    p95=1000 * _nearest_rank(samples, 95),
+                    p99=1000 * _nearest_rank(samples, 99),
+                    max=1000 * self._max)
+
+
+# Paces a loop against absolute deadlines on clock (the monotonic clock, unless given another), rather than sleeping a fixed time after each
+# iteration (which lets the period drift by however long the work took).
+# Usage:
+#    scheduler = DeadlineScheduler(0.1)
+#    while running:
+#        scheduler.wait()
+#        do_work()
+#        scheduler.done()
+# Records how late each iteration started (jitter), how long each took (latency), how many finished after the next
+# deadline (overruns), and how many deadlines were skipped altogether because the loop fell a whole period behind.
+class DeadlineScheduler:
+
+    def __init__(self, interval_s: float, stats_window_size=600, clock=REAL_CLOCK):
+        self._interval_s = interval_s
+        self._clock = clock
+        self._deadline_s = None
+        self._tick_start_s = None
+        self.jitter = TimingStats(stats_window_size)
+        self.latency = TimingStats(stats_window_size)
+        self.overruns = 0
+        self.skipped = 0
+
+    def get_interval(self) -> float:
+        return self._interval_s
+
+    # Sleep until the next deadline. Returns the deadline (clock seconds) this iteration belongs to.
+    def wait(self) -> float:
+        now_s = self._clock.time()
+        if self._deadline_s is None:
+            self._deadline_s = now_s
+        else:
+            self._deadline_s += self._interval_s
+            if now_s - self._deadline_s >= self._interval_s:
+                # Fell behind by one or more whole periods. Skip them rather than running a burst of late iterations.
+                missed = int((now_s - self._deadline_s) / self._interval_s)
+                self.skipped += missed
+                self._deadline_s += missed * self._interval_s
+            if self._deadline_s > now_s:
+                self._clock.sleep(self._deadline_s - now_s)
+        self._tick_start_s = self._clock.time()
+        self.jitter.add(self._tick_start_s - self._deadline_s)
+        return self._deadline_s
+
+    # Call at the end of each iteration's work.
+    def done(self):
+        now_s = self._clock.time()
+        self.latency.add(now_s - self._tick_start_s)
+        if now_s > self._deadline_s + self._interval_s:
+            self.overruns += 1
+
+    def get_stats(self) -> dict:
+        return dict(interval_ms=1000 * self._interval_s,
+                    iterations=self.latency.get_count(),
+                    overruns=self.overruns,
+                    skipped=self.skipped,
+                    jitter_ms=self.jitter.summary_ms(),
+                    latency_ms=self.latency.summary_ms())
@@ -8,18 +8,34 @@ class Sensor:
         self._imu_interface = get_interface()
         self._imu_interface.start()
 
+    # All the latest IMU readings, from the same sample. Use this, rather than several of the getters below, when
+    # the values need to be consistent with each other.
+    def get_sample(self):
+        return self._imu_interface.get_sample()
+
+    # Seconds since the latest IMU sample was taken. None if there has not been one yet.
+    def get_sample_age(self):
+        return self._imu_interface.get_sample().get_age()
+
     def get_heading(self):
         return self._imu_interface.compass_deg()
 
     def get_heel_angle(self):
         return self._imu_interface.heel_deg()
 
+    # Degrees per second, positive turning to starboard.
+    def get_yaw_rate(self):
+        return self._imu_interface.yaw_rate_dps()
+
     def get_pitch_variation_degrees(self): pass  # TODO implement
 
     def get_yaw_variation_degrees(self): pass # TODO Implement
 
     def get_accel_variation_gs(self): pass  # TODO Implement
 
+    def get_imu_stats(self) -> dict:
+        return self._imu_interface.get_stats()
+
     def get_temp_celsius(self):
         return self._imu_interface.temp
 
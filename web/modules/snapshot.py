@@ -0,0 +1,59 @@
+## Adrian Vrouwenvelder
+## March 2023
+
+import json
+
+
+def format_heel(heel) -> str:
+    heel_str = "LEVEL"
+    if heel >= 1.5:
+        heel_str = f'{heel:03.0f} STBD'
+    elif heel <= -1.5:
+        heel_str = f'{-heel:03.0f} PORT'
+    return heel_str
+
+
+# Immutable picture of the brain's state, published once per tick by the Brain.
+# Every reader is handed the same object, so the state is read (and encoded as JSON) once per tick,
+# no matter how many web clients are asking.
+class BrainSnapshot:
+    __slots__ = ('version', 'timestamp', 'heading', 'heel', 'course', 'clutch_status',
+                 'starboard_limit', 'port_limit', 'motor_speed', 'motor_direction',
+                 'rudder_position', 'rudder_direction', 'messages', 'json')
+
+    def __init__(self, version, timestamp, heading, heel, course, clutch_status,
+                 starboard_limit, port_limit, motor_speed, motor_direction,
+                 rudder_position, rudder_direction, messages):
+        set_field = super().__setattr__
+        set_field('version', version)  # Increases by one with every published snapshot
+        set_field('timestamp', timestamp)  # time.monotonic() at which the snapshot was taken
+        set_field('heading', heading)
+        set_field('heel', heel)
+        set_field('course', course)
+        set_field('clutch_status', clutch_status)
+        set_field('starboard_limit', starboard_limit)
+        set_field('port_limit', port_limit)
+        set_field('motor_speed', motor_speed)
+        set_field('motor_direction', motor_direction)
+        set_field('rudder_position', rudder_position)
+        set_field('rudder_direction', rudder_direction)
+        set_field('messages', messages)
+        # The web frame, encoded once. Version and timestamp are left out so that unchanged states encode identically.
+        set_field('json', json.dumps(self.to_frame()))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"BrainSnapshot is immutable (tried to set '{name}')")
+
+    # The fields served by the web interface's get_ routes, formatted the same way.
+    def to_frame(self) -> dict:
+        return dict(messages=self.messages,
+                    course=f"{self.course:03.0f}",
+                    heading=f"{self.heading:03.0f}",
+                    heel=format_heel(self.heel),
+                    clutch_status=self.clutch_status,
+                    starboard_limit=self.starboard_limit,
+                    port_limit=self.port_limit,
+                    motor_speed=self.motor_speed,
+                    motor_direction=self.motor_direction,
+                    rudder_position=self.rudder_position,
+                    rudder_direction=self.rudder_direction)